@@ -0,0 +1,798 @@
+"""
+Chat server benchmark
+
+This script starts myserver.py on a local port and drives it with many simulated
+clients from a single process, multiplexed with selectors, so the numbers reflect
+the server rather than client side threads.
+
+Usage:
+   python3 benchmark.py broadcast [--backend thread|selector] [--clients 10,50,200] [--messages 200] [--senders 1]
+   python3 benchmark.py framing [--messages 200000]
+   python3 benchmark.py workers [--backend thread|selector] [--clients 200] [--workers 1,2,4] [--messages 200]
+   python3 benchmark.py reconnect [--backend thread|selector] [--clients 10,50,200] [--rounds 5]
+   python3 benchmark.py pipeline [--backend thread|selector] [--messages 20000] [--batch 100]
+   python3 benchmark.py suite [--backend thread|selector] [--clients 1000] [--workers 1] [--output results.json]
+   python3 benchmark.py compression [--backend thread|selector] [--clients 20] [--messages 200]
+   python3 benchmark.py federation [--backend thread|selector] [--servers 3] [--clients 200] [--messages 200] [--pms 10]
+
+  broadcast
+      Registers every client with /username, then the first --senders clients each
+      send a burst of public messages at the same time and the time until every
+      client has received all of them is measured. Fan-out is not serialised by a
+      server-wide lock, so deliveries per second should hold or grow as
+      connections are added instead of collapsing.
+
+  framing
+      Feeds a burst of --messages short lines, then a burst of long lines, through
+      Receiver's line framing in this process, in reads of 1 KiB and of
+      Receiver.receiveBufferSize, and compares messages per second against the
+      old str based partition loop.
+
+  workers
+      Runs myserver.py with each --workers count, processes sharing the port via
+      SO_REUSEPORT, and times every client sending --messages /help requests.
+      The requests need no cross-worker traffic, so throughput should rise
+      close to linearly with workers up to the number of CPU cores.
+
+  reconnect
+      A reconnect storm, as after a deploy: for --rounds rounds every client
+      connects, claims a username at once and disconnects again. Reports
+      registrations per second, timed from the first /username to the last
+      confirmation of each round.
+
+  pipeline
+      One ex2utils Client sends --messages chat messages to another, first with
+      a send() per message, then with sendLines() in batches of --batch, and
+      times each run until ack() confirms the server has processed all of them.
+      Client.send only queues, so this is bounded by the server rather than the
+      half second pause every send used to take.
+
+  suite
+      The full load test, run against one server per --clients count. Every
+      client connects and registers, then --senders clients broadcast --messages
+      messages each, every client sends --pms private messages and --userlists
+      /userlist requests, and for --rounds rounds a tenth of the clients leave
+      and are replaced. Each phase reports messages per second, p50/p99 latency
+      from timestamps carried in the messages, and the server's CPU time and
+      resident memory, read from /proc, so memory per connection is measured
+      on connect. --output writes every result as JSON, tagged with the git
+      commit, so runs of different versions can be compared.
+
+  compression
+      Runs the same traffic over text and binary connections, each plain and
+      with deflate negotiated: every client registers, one sends --messages chat
+      lines of a few words to all the others, and every client asks for /help
+      and /userlist. Reports the bytes the clients received off the wire and
+      the CPU time the server and the clients spent, so the bandwidth saved
+      can be weighed against the cost of compressing every connection.
+
+  federation
+      Starts --servers instances of myserver.py on loopback ports, the first
+      with --hub and the others with --link to it, spreads the clients over them
+      round robin and registers them all, then one client broadcasts --messages
+      messages and every client sends --pms private messages to a client on the
+      next server. Reports rates and p50/p99 latency, and counts duplicate
+      deliveries, which should be zero as every server links only to the hub.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+from ex2utils import Client, Receiver, TEXT_CODEC
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def startServer(port, backend, workers=1, options=()):
+    """Run myserver.py in a child process and wait until it accepts connections."""
+    # rate limits are off, the scenarios measure the server flat out
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, 'myserver.py'), '127.0.0.1', str(port), backend,
+                               '--workers', str(workers), '--rate', '0', '--user-rate', '0', '--broadcast-rate', '0',
+                               *options],
+                              stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            if workers > 1:
+                # the first worker is up, give the rest time to bind the port too
+                time.sleep(1)
+            return server
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("server did not start")
+
+
+def freePort():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class LoadClient():
+    """One simulated connection, counting received lines that contain a marker."""
+
+    def __init__(self, port):
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.setblocking(False)
+        self.pending = b''
+        self.matched = 0
+        self.heardAt = time.perf_counter()
+        # called with every received line when set, instead of counting the marker
+        self.onLine = None
+        # set once the server has closed the connection
+        self.closed = False
+
+    def send(self, data):
+        self.socket.setblocking(True)
+        self.socket.sendall(data)
+        self.socket.setblocking(False)
+
+    def receive(self, marker):
+        try:
+            data = self.socket.recv(65536)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            data = b''
+        if not data:
+            self.closed = True
+            return
+        self.heardAt = time.perf_counter()
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            if self.onLine is not None:
+                self.onLine(line)
+            elif marker in line:
+                self.matched += 1
+
+
+def pump(clients, marker, done, timeout, actions=()):
+    """
+    Read from every client until done() holds, returns the elapsed time.
+    The next of actions, if any, runs on every pass so sends interleave with reads.
+    """
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client.socket, selectors.EVENT_READ, client)
+    actions = iter(actions)
+    sending = True
+    start = time.perf_counter()
+    try:
+        while sending or not done():
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError("timed out waiting for the server")
+            if sending:
+                action = next(actions, None)
+                sending = action is not None
+                if sending:
+                    action()
+            for key, mask in selector.select(0 if sending else 0.1):
+                key.data.receive(marker)
+    finally:
+        selector.close()
+    return time.perf_counter() - start
+
+
+def register(clients):
+    """Give every client a username and wait for all the chat room notices."""
+    for index, client in enumerate(clients):
+        client.send(b'/username user%d\n' % index)
+    # every registration is announced to every client already in the chat room
+    expected = len(clients) * (len(clients) + 1) // 2
+    pump(clients, b'has been connected to the chatroom', lambda: sum(c.matched for c in clients) >= expected, 60)
+
+
+def broadcast(port, clients, messages, senders=1):
+    """Time the fan-out of bursts of public messages from the first few clients."""
+    senders = min(senders, clients)
+    connections = [LoadClient(port) for i in range(clients)]
+    try:
+        register(connections)
+        for client in connections:
+            client.matched = 0
+        # everyone hears every sender except itself
+        expected = [messages * (senders - (index < senders)) for index in range(clients)]
+        burst = b''.join(b'message %d\n' % i for i in range(messages))
+        for sender in connections[:senders]:
+            sender.send(burst)
+        done = lambda: all(c.matched >= e for c, e in zip(connections, expected))
+        elapsed = pump(connections, b'Message from user', done, 120)
+    finally:
+        for client in connections:
+            client.socket.close()
+    deliveries = sum(expected)
+    return {'clients': clients, 'deliveries': deliveries, 'seconds': elapsed, 'deliveries_per_sec': deliveries / elapsed}
+
+
+def roundTrips(port, clients, messages):
+    """Time every client sending a burst of /help requests and reading the replies."""
+    connections = [LoadClient(port) for i in range(clients)]
+    try:
+        burst = b'/help\n' * messages
+        for client in connections:
+            client.send(burst)
+        elapsed = pump(connections, b'Available commands', lambda: all(c.matched >= messages for c in connections), 300)
+    finally:
+        for client in connections:
+            client.socket.close()
+    requests = clients * messages
+    return {'clients': clients, 'requests': requests, 'seconds': elapsed, 'requests_per_sec': requests / elapsed}
+
+
+def reconnectStorm(port, clients, rounds):
+    """Time rounds of every client connecting, registering and leaving together."""
+    elapsed = 0
+    for round in range(rounds):
+        connections = [LoadClient(port) for i in range(clients)]
+        try:
+            # only registration is timed, connecting is bounded by the listen backlog instead
+            start = time.perf_counter()
+            for index, client in enumerate(connections):
+                client.send(b'/username r%du%d\n' % (round, index))
+            pump(connections, b'Username has set to', lambda: all(c.matched for c in connections), 120)
+            elapsed += time.perf_counter() - start
+        finally:
+            for client in connections:
+                client.socket.close()
+    registrations = clients * rounds
+    return {'clients': clients, 'registrations': registrations, 'seconds': elapsed,
+            'registrations_per_sec': registrations / elapsed}
+
+
+def settle(clients, quiet=0.25):
+    """Drain what the server still sends until it has been quiet a while, returns when it was last heard."""
+    pump(clients, None, lambda: time.perf_counter() - max(c.heardAt for c in clients) > quiet, 300)
+    return max(c.heardAt for c in clients)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[round(fraction * (len(values) - 1))] if values else None
+
+
+def latencies(samples):
+    """p50, p99 and max of nanosecond samples, in milliseconds."""
+    return {'samples': len(samples),
+            'p50_ms': percentile(samples, 0.5) / 1e6 if samples else None,
+            'p99_ms': percentile(samples, 0.99) / 1e6 if samples else None,
+            'max_ms': max(samples) / 1e6 if samples else None}
+
+
+def stamped(line):
+    """Nanoseconds since the 'bench <timestamp>' carried by line was sent."""
+    return time.perf_counter_ns() - int(line[line.rindex(b'bench ') + 6:].split(b'\x1b', 1)[0])
+
+
+def processTree(pid):
+    """pid and all of its descendants, such as worker processes, from /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as stat:
+                    parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+    tree = [pid]
+    for process in tree:
+        tree.extend(children.get(process, []))
+    return tree
+
+
+def serverUsage(pid):
+    """Resident bytes and CPU seconds used so far by the server and its workers."""
+    rss = cpu = 0
+    for process in processTree(pid):
+        try:
+            with open(f'/proc/{process}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{process}/status') as status:
+                rss += next(int(line.split()[1]) * 1024 for line in status if line.startswith('VmRSS:'))
+        except (OSError, StopIteration):
+            continue
+        # utime and stime, in clock ticks
+        cpu += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return rss, cpu
+
+
+def measured(server, phase, *args):
+    """Run one suite phase, adding the CPU time and memory it took to its result."""
+    (rssBefore, cpuBefore) = serverUsage(server.pid)
+    clientCpu = time.process_time()
+    result = phase(*args)
+    (rss, cpu) = serverUsage(server.pid)
+    result.update({'server_cpu_seconds': cpu - cpuBefore,
+                   'server_cpu_percent': 100 * (cpu - cpuBefore) / result['seconds'],
+                   'client_cpu_seconds': time.process_time() - clientCpu,
+                   'server_rss_bytes': rss,
+                   'server_rss_growth_bytes': rss - rssBefore})
+    return result
+
+
+def connectAll(port, count, connections):
+    """Open count connections and wait until the server has greeted every one."""
+    samples = []
+    start = time.perf_counter()
+    for i in range(count):
+        # a full listen backlog shows up here as SYN retries of a second or more
+        connectedAt = time.perf_counter_ns()
+        connections.append(LoadClient(port))
+        samples.append(time.perf_counter_ns() - connectedAt)
+    # every connection is greeted, and announced to the others on its worker
+    pump(connections, b'/help to refer commands.', lambda: all(c.matched for c in connections), 300)
+    elapsed = settle(connections) - start
+    return dict({'connections': count, 'seconds': elapsed, 'connections_per_sec': count / elapsed}, **latencies(samples))
+
+
+def registerAll(connections):
+    """Claim a username on every connection, timing each until its confirmation."""
+    samples = []
+    notices = [0]
+    for (index, client) in enumerate(connections):
+        client.onLine = lambda line, client=client: (
+            samples.append(time.perf_counter_ns() - client.sentAt) if b'Username has set to' in line else
+            notices.__setitem__(0, notices[0] + (b'has been connected to the chatroom' in line)))
+
+    def send(client, index):
+        client.sentAt = time.perf_counter_ns()
+        client.send(b'/username u%d\n' % index)
+
+    # the joins are announced to everyone in the chat room, those notices are drained too
+    start = time.perf_counter()
+    pump(connections, None, lambda: len(samples) == len(connections), 300,
+         (lambda client=client, index=index: send(client, index) for (index, client) in enumerate(connections)))
+    elapsed = settle(connections) - start
+    return dict({'registrations': len(connections), 'notices': notices[0], 'seconds': elapsed,
+                 'messages_per_sec': (len(connections) + notices[0]) / elapsed}, **latencies(samples))
+
+
+def broadcastAll(connections, senders, messages):
+    """Fan out timestamped public messages from the first senders clients."""
+    senders = connections[:min(senders, len(connections))]
+    samples = []
+    for client in connections:
+        client.onLine = lambda line: b'Message from' in line and samples.append(stamped(line))
+
+    def send():
+        for sender in senders:
+            sender.send(b'bench %d\n' % time.perf_counter_ns())
+
+    # everyone hears every sender except itself
+    deliveries = messages * len(senders) * (len(connections) - 1)
+    elapsed = pump(connections, None, lambda: len(samples) >= deliveries, 300, (send for i in range(messages)))
+    return dict({'senders': len(senders), 'messages': messages * len(senders), 'deliveries': deliveries,
+                 'seconds': elapsed, 'messages_per_sec': deliveries / elapsed}, **latencies(samples))
+
+
+def privateAll(connections, pms):
+    """Every client sends pms timestamped private messages to the next client."""
+    samples = []
+    for client in connections:
+        client.onLine = lambda line: b'Private message from' in line and samples.append(stamped(line))
+
+    def send():
+        for (index, client) in enumerate(connections):
+            client.send(b'/pm u%d bench %d\n' % ((index + 1) % len(connections), time.perf_counter_ns()))
+
+    deliveries = pms * len(connections)
+    elapsed = pump(connections, None, lambda: len(samples) >= deliveries, 300, (send for i in range(pms)))
+    return dict({'messages': deliveries, 'seconds': elapsed, 'messages_per_sec': deliveries / elapsed},
+                **latencies(samples))
+
+
+def userlistAll(connections, requests):
+    """Every client asks for /userlist requests times, timing each round trip."""
+    samples = []
+    lines = [0]
+    reset = b'\x1b[0m'
+
+    def onLine(client, line):
+        # a list of several users spans lines, and only its last line ends with the reset code alone.
+        # the server sends a page of the list at a time, so count the lines that actually came
+        lines[0] += 1
+        if line.endswith(reset) and (not line.startswith(b'\x1b') or len(connections) == 1):
+            samples.append(time.perf_counter_ns() - client.sentAt.pop(0))
+
+    for client in connections:
+        client.sentAt = []
+        client.onLine = lambda line, client=client: onLine(client, line)
+
+    def send():
+        for client in connections:
+            client.sentAt.append(time.perf_counter_ns())
+            client.send(b'/userlist\n')
+
+    total = requests * len(connections)
+    elapsed = pump(connections, None, lambda: len(samples) >= total, 300, (send for i in range(requests)))
+    return dict({'requests': total, 'seconds': elapsed, 'requests_per_sec': total / elapsed,
+                 'lines_per_sec': lines[0] / elapsed}, **latencies(samples))
+
+
+def churnAll(port, connections, rounds, fraction=0.1):
+    """Each round a slice of the clients leaves and new clients connect and register."""
+    samples = []
+    count = max(1, int(len(connections) * fraction))
+    elapsed = 0
+    for round in range(rounds):
+        first = (round * count) % len(connections)
+        leaving = connections[first:first + count]
+        start = time.perf_counter()
+        for client in leaving:
+            client.socket.close()
+        joining = []
+        for index in range(len(leaving)):
+            client = LoadClient(port)
+            client.sentAt = time.perf_counter_ns()
+            client.onLine = lambda line, client=client: (
+                b'Username has set to' in line and samples.append(time.perf_counter_ns() - client.sentAt))
+            client.send(b'/username c%du%d\n' % (round, index))
+            joining.append(client)
+        connections[first:first + count] = joining
+        pump(connections, None, lambda: len(samples) >= (round + 1) * count, 300)
+        elapsed += time.perf_counter() - start
+    return dict({'rounds': rounds, 'replaced': rounds * count, 'seconds': elapsed,
+                 'replacements_per_sec': rounds * count / elapsed}, **latencies(samples))
+
+
+def suite(port, server, clients, senders, messages, pms, userlists, rounds):
+    """Run every phase against one server, returns the results by phase."""
+    connections = []
+    results = {}
+    try:
+        (rss, cpu) = serverUsage(server.pid)
+        results['connect'] = measured(server, connectAll, port, clients, connections)
+        results['connect']['bytes_per_connection'] = results['connect']['server_rss_growth_bytes'] / clients
+        results['register'] = measured(server, registerAll, connections)
+        results['broadcast'] = measured(server, broadcastAll, connections, senders, messages)
+        results['pm'] = measured(server, privateAll, connections, pms)
+        results['userlist'] = measured(server, userlistAll, connections, userlists)
+        results['churn'] = measured(server, churnAll, port, connections, rounds)
+    finally:
+        for client in connections:
+            client.socket.close()
+    return results
+
+
+def federation(backend, servers, clients, messages, pms):
+    """
+    Link servers on loopback ports into one chat room, the first running the bus hub,
+    and measure broadcasts and private messages between clients spread over all of them.
+    """
+    hub = freePort()
+    ports = [freePort() for i in range(servers)]
+    processes = []
+    connections = []
+    results = {}
+    try:
+        processes.append(startServer(ports[0], backend, options=['--hub', '127.0.0.1:%d' % hub]))
+        for port in ports[1:]:
+            processes.append(startServer(port, backend, options=['--link', '127.0.0.1:%d' % hub]))
+        # round robin, so the next client, the one each /pm goes to, is on the next server
+        for index in range(clients):
+            connections.append(LoadClient(ports[index % servers]))
+        pump(connections, b'/help to refer commands.', lambda: all(c.matched for c in connections), 60)
+        results['register'] = registerAll(connections)
+        results['broadcast'] = broadcastAll(connections, 1, messages)
+        # a message relayed twice through the hub shows up after the expected count was reached
+        duplicates = [0]
+        for client in connections:
+            client.onLine = lambda line: duplicates.__setitem__(0, duplicates[0] + (b'Message from' in line))
+        settle(connections)
+        results['broadcast']['duplicates'] = duplicates[0]
+        results['pm'] = privateAll(connections, pms)
+    finally:
+        for client in connections:
+            client.socket.close()
+        for process in processes:
+            process.terminate()
+            process.wait()
+    return results
+
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class PipelineClient(Client):
+    """A Client counting the chat room messages it hears, and the bytes that carried them."""
+
+    def __init__(self):
+        super(PipelineClient, self).__init__()
+        self.heard = 0
+        self.wireBytes = 0
+
+    def _receive(self, wrappedSocket, data):
+        self.wireBytes += len(data)
+        return super(PipelineClient, self)._receive(wrappedSocket, data)
+
+    def onMessage(self, socket, message):
+        self.heard += 'Message from' in message
+        return True
+
+
+def pipeline(port, messages, batch):
+    """Messages per second from one Client, sent one by one and then in batches."""
+    (sender, listener) = (PipelineClient(), PipelineClient())
+    sender.start('127.0.0.1', port)
+    listener.start('127.0.0.1', port)
+    results = []
+    try:
+        sender.send(b'/username sender')
+        listener.send(b'/username listener')
+        sender.ack()
+        listener.ack()
+        lines = [b'bench %d' % i for i in range(messages)]
+        for (name, send) in [('send', lambda: [sender.send(line) for line in lines]),
+                             ('sendLines', lambda: [sender.sendLines(lines[i:i + batch])
+                                                    for i in range(0, messages, batch)])]:
+            start = time.perf_counter()
+            send()
+            if not sender.ack(120):
+                raise RuntimeError("timed out waiting for the server")
+            elapsed = time.perf_counter() - start
+            results.append({'mode': name, 'messages': messages, 'seconds': elapsed,
+                            'messages_per_sec': messages / elapsed})
+        listener.ack()
+        assert listener.heard == 2 * messages
+    finally:
+        sender.stop()
+        listener.stop()
+    return results
+
+
+WORDS = ('the', 'server', 'meeting', 'is', 'at', 'noon', 'deploy', 'looks', 'good', 'to', 'me', 'can', 'you', 'check',
+         'logs', 'again', 'thanks', 'lunch', 'anyone', 'build', 'failed', 'on', 'main', 'fixed', 'it', 'now')
+
+
+def compression(port, server, clients, messages, protocol, compress):
+    """Bytes on the wire and CPU time for registrations, chat, /help and /userlist over one protocol."""
+    chooser = random.Random(1)
+    lines = [' '.join(chooser.choice(WORDS) for i in range(chooser.randint(3, 20))).encode() for i in range(messages)]
+    connections = []
+    try:
+        for index in range(clients):
+            client = PipelineClient()
+            client.start('127.0.0.1', port, protocol, compress)
+            connections.append(client)
+        (rss, cpuBefore) = serverUsage(server.pid)
+        clientCpu = time.process_time()
+        wireBefore = sum(client.wireBytes for client in connections)
+        start = time.perf_counter()
+        for (index, client) in enumerate(connections):
+            client.send(b'/username user%d' % index)
+        for client in connections:
+            client.ack(60)
+        connections[0].sendLines(lines)
+        for client in connections:
+            client.sendLines([b'/help', b'/userlist'])
+        # everyone but the sender hears every line
+        deadline = time.time() + 120
+        while not all(client.heard >= messages for client in connections[1:]):
+            if time.time() > deadline:
+                raise RuntimeError("timed out waiting for the server")
+            time.sleep(0.01)
+        for client in connections:
+            client.ack(60)
+        elapsed = time.perf_counter() - start
+        (rss, cpu) = serverUsage(server.pid)
+    finally:
+        for client in connections:
+            client.stop()
+    return {'protocol': protocol + (' deflate' if compress else ''), 'clients': clients, 'messages': messages,
+            'wire_bytes': sum(client.wireBytes for client in connections) - wireBefore, 'seconds': elapsed,
+            'server_cpu_seconds': cpu - cpuBefore, 'client_cpu_seconds': time.process_time() - clientCpu}
+
+
+def legacyFraming(chunks):
+    """The str concatenation and partition loop Receiver used to run, as a baseline."""
+    receiver = CountingReceiver()
+    stored = ''
+    for chunk in chunks:
+        stored += chunk.decode()
+        while receiver.isRunning():
+            (message, sep, rest) = stored.partition('\n')
+            if sep == '':
+                break
+            stored = rest
+            receiver.onMessage(None, message)
+    return receiver.messages
+
+
+class CountingReceiver(Receiver):
+    def __init__(self):
+        super(CountingReceiver, self).__init__()
+        self.messages = 0
+
+    def onMessage(self, socket, message):
+        self.messages += 1
+        return True
+
+
+class FramingState():
+    """Stands in for a wrapped socket, holding only the framing buffer."""
+
+    def __init__(self):
+        self._stored = bytearray()
+        self._scanned = 0
+        self._negotiating = None
+        self._bucket = None
+        self.codec = TEXT_CODEC
+        self.deflate = None
+
+
+def bytearrayFraming(chunks):
+    receiver = CountingReceiver()
+    state = FramingState()
+    for chunk in chunks:
+        receiver._receive(state, chunk)
+    return receiver.messages
+
+
+def framing(messages, lineLength=40):
+    """Messages per second through each framing loop for the same burst."""
+    line = b'x' * (lineLength - 1) + b'\n'
+    payload = line * messages
+    results = []
+    for name, frame, readSize in [('str partition', legacyFraming, 1024),
+                                  ('str partition', legacyFraming, Receiver.receiveBufferSize),
+                                  ('bytearray', bytearrayFraming, 1024),
+                                  ('bytearray', bytearrayFraming, Receiver.receiveBufferSize)]:
+        chunks = [payload[i:i + readSize] for i in range(0, len(payload), readSize)]
+        start = time.perf_counter()
+        counted = frame(chunks)
+        elapsed = time.perf_counter() - start
+        assert counted == messages
+        results.append({'framing': name, 'read_size': readSize, 'line_length': lineLength, 'messages': messages,
+                        'seconds': elapsed, 'messages_per_sec': messages / elapsed})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat server.")
+    parser.add_argument('scenario', choices=['broadcast', 'framing', 'workers', 'reconnect', 'pipeline', 'suite',
+                                                 'compression', 'federation'])
+    parser.add_argument('--backend', default='thread', choices=['thread', 'selector'])
+    parser.add_argument('--clients', help="comma separated connection counts (10,50,200, or 1000 for suite)")
+    parser.add_argument('--messages', type=int, help="messages sent by each sender (200, 20 for suite), or framed (200000)")
+    parser.add_argument('--senders', type=int, default=1)
+    parser.add_argument('--workers', default='1,2,4', help="comma separated worker process counts, the first for suite")
+    parser.add_argument('--servers', type=int, default=3, help="linked server instances in federation")
+    parser.add_argument('--rounds', type=int, default=5, help="reconnect storms, or churn rounds, to run")
+    parser.add_argument('--pms', type=int, default=10, help="private messages sent by each client in suite")
+    parser.add_argument('--userlists', type=int, default=2, help="/userlist requests sent by each client in suite")
+    parser.add_argument('--output', help="write the suite results to this JSON file")
+    parser.add_argument('--batch', type=int, default=100, help="lines per sendLines() call in pipeline")
+    args = parser.parse_args()
+    args.clients = args.clients or ('1000' if args.scenario == 'suite' else '10,50,200')
+
+    # thousands of connections need as many file descriptors, the server inherits the limit
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if args.scenario == 'framing':
+        # short chat lines, then long lines spanning many reads
+        for result in framing(args.messages or 200000) + framing((args.messages or 200000) // 200, 60000):
+            print(f"{result['framing']:>14} {result['read_size']:>6} byte reads  {result['line_length']:>6} byte lines  "
+                  f"{result['seconds']:8.3f} s  {result['messages_per_sec']:>10.0f} messages/s")
+        return
+
+    if args.scenario == 'workers':
+        clients = int(args.clients.split(',')[-1])
+        print(f"{os.cpu_count()} CPU cores")
+        for workers in [int(count) for count in args.workers.split(',')]:
+            port = freePort()
+            server = startServer(port, args.backend, workers)
+            try:
+                result = roundTrips(port, clients, args.messages or 200)
+            finally:
+                server.terminate()
+                server.wait()
+            print(f"{workers:>3} workers  {result['clients']:>6} clients  {result['requests']:>8} requests  "
+                  f"{result['seconds']:8.3f} s  {result['requests_per_sec']:>10.0f} requests/s")
+        return
+
+    if args.scenario == 'pipeline':
+        port = freePort()
+        server = startServer(port, args.backend)
+        try:
+            results = pipeline(port, args.messages or 20000, args.batch)
+        finally:
+            server.terminate()
+            server.wait()
+        for result in results:
+            print(f"{result['mode']:>10}  {result['messages']:>8} messages  {result['seconds']:8.3f} s  "
+                  f"{result['messages_per_sec']:>10.0f} messages/s")
+        return
+
+    if args.scenario == 'compression':
+        clients = int(args.clients.split(',')[-1]) if args.clients != '10,50,200' else 20
+        plain = {}
+        for (protocol, compress) in [('text', False), ('text', True), ('binary', False), ('binary', True)]:
+            port = freePort()
+            server = startServer(port, args.backend)
+            try:
+                result = compression(port, server, clients, args.messages or 200, protocol, compress)
+            finally:
+                server.terminate()
+                server.wait()
+            ratio = result['wire_bytes'] / plain.setdefault(protocol, result['wire_bytes'])
+            print(f"{result['protocol']:>14}  {result['clients']:>4} clients  {result['wire_bytes']:>10} bytes  "
+                  f"{ratio:6.1%}  {result['seconds']:8.3f} s  server cpu {result['server_cpu_seconds']:6.3f} s  "
+                  f"client cpu {result['client_cpu_seconds']:6.3f} s")
+        return
+
+    if args.scenario == 'federation':
+        clients = int(args.clients.split(',')[-1])
+        results = federation(args.backend, args.servers, clients, args.messages or 200, args.pms)
+        print(f"{args.servers} servers, {clients} clients, {args.backend} backend")
+        for (name, result) in results.items():
+            rate = next(value for (key, value) in result.items() if key.endswith('_per_sec'))
+            print(f"  {name:>9}  {result['seconds']:8.3f} s  {rate:>10.0f}/s  "
+                  f"p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms")
+        print(f"  {results['broadcast']['duplicates']} duplicate deliveries")
+        return
+
+    if args.scenario == 'suite':
+        workers = int(args.workers.split(',')[0])
+        report = {'commit': gitCommit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'backend': args.backend,
+                  'workers': workers, 'python': platform.python_version(), 'cpus': os.cpu_count(), 'runs': []}
+        for clients in [int(count) for count in args.clients.split(',')]:
+            port = freePort()
+            server = startServer(port, args.backend, workers)
+            try:
+                results = suite(port, server, clients, args.senders, args.messages or 20, args.pms, args.userlists,
+                                args.rounds)
+            finally:
+                server.terminate()
+                server.wait()
+            report['runs'].append({'clients': clients, 'phases': results})
+            print(f"{clients} clients, {args.backend} backend, {workers} workers")
+            for (name, result) in results.items():
+                rate = next(value for (key, value) in result.items() if key.endswith('_per_sec'))
+                latency = f"p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms" if 'p50_ms' in result else ' ' * 29
+                print(f"  {name:>9}  {result['seconds']:8.3f} s  {rate:>10.0f}/s  {latency}  "
+                      f"server cpu {result['server_cpu_percent']:5.1f}%  rss {result['server_rss_bytes'] / 2**20:7.1f} MiB")
+            print(f"  {results['connect']['bytes_per_connection']:.0f} bytes of server memory per connection")
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(report, output, indent=2)
+        return
+
+    for clients in [int(count) for count in args.clients.split(',')]:
+        port = freePort()
+        server = startServer(port, args.backend)
+        try:
+            if args.scenario == 'reconnect':
+                result = reconnectStorm(port, clients, args.rounds)
+            else:
+                result = broadcast(port, clients, args.messages or 200, args.senders)
+        finally:
+            server.terminate()
+            server.wait()
+        if args.scenario == 'reconnect':
+            print(f"{result['clients']:>6} clients  {result['registrations']:>8} registrations  "
+                  f"{result['seconds']:8.3f} s  {result['registrations_per_sec']:>10.0f} registrations/s")
+            continue
+        print(f"{result['clients']:>6} clients  {result['deliveries']:>8} deliveries  "
+              f"{result['seconds']:8.3f} s  {result['deliveries_per_sec']:>10.0f} deliveries/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,98 +4,976 @@ ex2utils.py-
 """
 
 
+import array
+import asyncio
+import bisect
+import errno
+import heapq
+import hmac
+import inspect
+import json
+import logging
+import logging.handlers
+import mmap
+import os
+import queue
+import sys
 import threading
 import time
+import itertools
+import collections
+import selectors
+import sqlite3
+import http.server
 import socket as socketlib
+import struct
+import zlib
+
+
+# Kinds of message. Text connections get them rendered with colours by the
+# sender, binary connections get the fields and render them on their own side.
+TEXT, NOTICE, ERROR, PUBLIC, ECHO, PRIVATE_FROM, PRIVATE_TO, USER_LIST, PING, PONG, ROOM_PUBLIC, ROOM_ECHO = range(12)
+
+# key = kind, value = (colour, template)
+STYLES = {
+	TEXT: ("", "{body}"),
+	NOTICE: ("\033[1;33m", "{body}"),
+	ERROR: ("\033[1;31;43m", "{body}"),
+	PUBLIC: ("\033[1;32m", "Message from {sender}: {body}"),
+	ECHO: ("\033[1;35m", "Message to everyone: {body}"),
+	PRIVATE_FROM: ("\033[1;36m", "Private message from {sender}: {body}"),
+	PRIVATE_TO: ("\033[1;94m", "Private message to {target}: {body}"),
+	USER_LIST: ("\033[1;33m", "{body}"),
+	PING: ("", "/ping {body}"),
+	PONG: ("", "/pong {body}"),
+	ROOM_PUBLIC: ("\033[1;32m", "[{target}] Message from {sender}: {body}"),
+	ROOM_ECHO: ("\033[1;35m", "[{target}] Message to the room: {body}"),
+}
+
+# Lines answered by the receiver itself instead of onMessage
+_CONTROL = ('/ping ', '/pong ')
+
+# Kinds of event in a Capture
+CAPTURE_CONNECT, CAPTURE_MESSAGE, CAPTURE_DISCONNECT = range(3)
+
+def render(kind, body, sender='', target=''):
+	"""The coloured line a text connection shows for a message."""
+	(colour, template) = STYLES.get(kind, STYLES[TEXT])
+	text = template.format(body = body, sender = sender, target = target)
+	return colour + text + "\033[0m" if colour else text
+
+
+class TextCodec():
+	"""
+	Newline delimited lines, the default protocol. Messages are rendered
+	before they are sent.
+	"""
+
+	name = 'text'
+
+	def line(self, msg):
+		# Ensure a single new-line after the message
+		return msg.strip()+b"\n"
+
+	def message(self, kind, body, sender='', target=''):
+		return self.line(render(kind, body, sender, target).encode())
+
+
+class BinaryCodec():
+	"""
+	Length prefixed frames carrying the fields of a message.
+
+	A frame is the 4 byte big-endian length of the rest of it, the kind byte,
+	the 2 byte lengths of sender and target, then sender, target and body in
+	UTF-8. Bodies may hold new-lines and nothing is scanned for a delimiter.
+	Sender and target are at most 65535 bytes each.
+	"""
+
+	name = 'binary'
+	header = struct.Struct('!IBHH')
+	# Longest sender or target in bytes
+	maxField = 0xFFFF
+
+	def line(self, msg):
+		return self.frame(TEXT, b'', b'', msg.strip())
+
+	def message(self, kind, body, sender='', target=''):
+		return self.frame(kind, sender.encode(), target.encode(), body.encode())
+
+	def frame(self, kind, sender, target, body):
+		# Checked here rather than left to struct, whose error says nothing of which field
+		if len(sender) > self.maxField or len(target) > self.maxField:
+			raise ValueError(f"sender and target must fit in {self.maxField} bytes, not {len(sender)} and {len(target)}")
+		length = 5 + len(sender) + len(target) + len(body)
+		return self.header.pack(length, kind, len(sender), len(target)) + sender + target + body
+
+	def fields(self, frame):
+		"""(kind, body, sender, target) of one whole frame."""
+		(length, kind, senderLength, targetLength) = self.header.unpack_from(frame)
+		middle = self.header.size + senderLength
+		end = middle + targetLength
+		sender = str(frame[self.header.size:middle], 'utf-8', 'replace')
+		target = str(frame[middle:end], 'utf-8', 'replace')
+		return (kind, str(frame[end:4 + length], 'utf-8', 'replace'), sender, target)
+
+
+TEXT_CODEC = TextCodec()
+BINARY_CODEC = BinaryCodec()
+# Protocols a connection can switch to with "/protocol <name>" as its first line
+CODECS = {codec.name: codec for codec in (TEXT_CODEC, BINARY_CODEC)}
+# Option of "/protocol" that compresses the connection under its codec
+DEFLATE = 'deflate'
+
+
+class DeflateStream():
+	"""
+	One zlib stream in each direction of a connection, below its codec.
+
+	Whatever the codec frames goes out as records: the 4 byte big-endian
+	length of the payload, its top bit set when the payload is compressed,
+	then the payload. Data shorter than `threshold` is sent as it is,
+	anything longer is deflated and sync flushed, so every record can be
+	inflated on arrival while the window carries over from one record to
+	the next. As in permessage-deflate, the empty block ending every sync
+	flush is left off the wire and put back before inflating.
+	"""
+
+	header = struct.Struct('!I')
+	compressedFlag = 1 << 31
+	syncTail = b'\x00\x00\xff\xff'
+	# Bytes compressed into one record, which is also the most one may inflate to
+	recordSize = 1 << 16
+
+	def __init__(self, threshold=32, level=6):
+		self.threshold = threshold
+		self._compressor = zlib.compressobj(level)
+		self._decompressor = zlib.decompressobj()
+		# Received bytes not yet forming a whole record
+		self._pending = bytearray()
+		# Counters
+		self.bytesIn = 0
+		self.bytesOut = 0
+
+	def pack(self, data):
+		"""The records carrying data."""
+		self.bytesIn += len(data)
+		if len(data) < min(self.threshold, self.recordSize):
+			records = self.header.pack(len(data)) + data
+		else:
+			parts = []
+			with memoryview(data) as view:
+				for start in range(0, len(view), self.recordSize):
+					payload = self._compressor.compress(view[start:start + self.recordSize])
+					payload = (payload + self._compressor.flush(zlib.Z_SYNC_FLUSH))[:-len(self.syncTail)]
+					parts.append(self.header.pack(self.compressedFlag | len(payload)))
+					parts.append(payload)
+			records = b"".join(parts)
+		self.bytesOut += len(records)
+		return records
+
+	def unpack(self, data):
+		"""The bytes carried by every whole record received so far, None if the stream is corrupt."""
+		pending = self._pending
+		pending += data
+		header = self.header
+		parts = []
+		offset = 0
+		while len(pending) - offset >= header.size:
+			(length,) = header.unpack_from(pending, offset)
+			compressed = length & self.compressedFlag
+			length &= ~self.compressedFlag
+			if length > self.recordSize + 1024:
+				return None
+			end = offset + header.size + length
+			if end > len(pending):
+				break
+			payload = bytes(pending[offset + header.size:end])
+			offset = end
+			if compressed:
+				try:
+					payload = self._decompressor.decompress(payload + self.syncTail, self.recordSize)
+				except zlib.error:
+					return None
+				# Inflating to more than a record holds is never sent by a peer
+				if self._decompressor.unconsumed_tail:
+					return None
+			parts.append(payload)
+		del pending[:offset]
+		return b"".join(parts)
 
 
 class Socket():
 	"""
 	Mutable wrapper class for sockets.
+
+	Sends are queued per connection and written without blocking, whatever is
+	left over is flushed by `writer`, an EventLoop watching for writability.
 	"""
 
-	def __init__(self, socket):
-		# Store internal socket pointer
+	def __init__(self, socket, writer=None, highWaterMark=1 << 20, overflowPolicy='disconnect', metrics=None):
+		# Store internal socket pointer, sends never block on it
 		self._socket = socket
+		self._socket.setblocking(False)
+		self._writer = writer if writer is not None else _sharedWriter()
+		# Bytes allowed to wait for a slow peer, and 'drop' or 'disconnect' beyond it
+		self.highWaterMark = highWaterMark
+		self.overflowPolicy = overflowPolicy
+		# Serialise writers so concurrent sends never interleave on the wire
+		self.metrics = metrics
+		self._sendLock = threading.Lock() if metrics is None else metrics.lock()
+		# Signalled whenever the queue runs empty, for flush()
+		self._drained = threading.Condition(self._sendLock)
+		# Write straight away when nothing is queued, otherwise every write is
+		# left to the writer loop, which batches whatever piled up meanwhile
+		self.writeThrough = True
+		# Frames waiting for the kernel, oldest first
+		self._outbound = collections.deque()
+		self._watching = False
+		self._broken = False
+		self._closeRequested = False
+		self._closed = False
+		# How messages are framed on this connection, see CODECS, and the
+		# DeflateStream compressing it once negotiated
+		self.codec = TEXT_CODEC
+		self.deflate = None
+		# Counters
+		self.queuedBytes = 0
+		self.bytesSent = 0
+		self.droppedMessages = 0
 	
 	def send(self, msg):
-		# Ensure a single new-line after the message
-		self._socket.send(msg.strip()+b"\n")
+		"""Queue the line msg for the peer, returns False if it was refused."""
+		with self._sendLock:
+			return self._queue(self.codec.line(msg))
+
+	def sendMessage(self, kind, body, sender='', target='', frames=None):
+		"""
+		Queue a message of the given kind, returns False if it was refused.
+
+		frames, when given, caches the encoding per codec so a broadcast encodes
+		the message once for each protocol in use.
+		"""
+		with self._sendLock:
+			codec = self.codec
+			if frames is None:
+				return self._queue(codec.message(kind, body, sender, target))
+			data = frames.get(codec)
+			if data is None:
+				data = frames[codec] = codec.message(kind, body, sender, target)
+			return self._queue(data)
+
+	def sendLines(self, msgs):
+		"""Queue many lines as a single frame, so they go out in one write."""
+		with self._sendLock:
+			return self._queue(b"".join(map(self.codec.line, msgs)))
+
+	def sendMessages(self, messages):
+		"""Queue many (kind, body, sender, target) messages as a single frame, so they go out in one write."""
+		with self._sendLock:
+			codec = self.codec
+			return self._queue(b"".join(codec.message(*message) for message in messages))
+
+	def sendFrame(self, data):
+		"""Queue bytes already framed for this socket's codec, shared buffers are never copied."""
+		with self._sendLock:
+			return self._queue(data)
+
+	def flush(self, timeout=None):
+		"""Block until everything queued has been written, False on timeout."""
+		with self._drained:
+			return self._drained.wait_for(lambda: not self._outbound, timeout)
+
+	def _switch(self, reply, codec, deflate=None):
+		"""Queue reply in the current protocol, then frame everything after it with codec, compressed by deflate."""
+		with self._sendLock:
+			if reply is not None:
+				self._queue(reply)
+			self.codec = codec
+			self.deflate = deflate
+
+	def _queue(self, data):
+		# Called with the send lock held, encoding under it keeps protocol switches atomic
+		if self._broken or self._closeRequested:
+			return False
+		# A single large reply always fits an empty queue. Checked on the frame
+		# before it is compressed, a dropped frame must never reach the stream
+		if self.queuedBytes and self.queuedBytes + len(data) > self.highWaterMark:
+			self._overflow()
+			return False
+		# Compressed in queue order, the stream must see frames as the peer will
+		if self.deflate is not None:
+			data = self.deflate.pack(data)
+		self._outbound.append(data)
+		self.queuedBytes += len(data)
+		# Only write directly when the writer is not already draining us
+		if not self._watching:
+			if self.writeThrough:
+				self._flush()
+			if self._outbound:
+				self._watching = True
+				self._writer.callSoon(self._writer.watchWrite, self._socket, self._onWritable)
+		return True
 		
+	def peerName(self):
+		"""The address of the peer, a path for Unix domain sockets."""
+		return self._socket.getpeername()
+
 	def close(self):
-		self._socket.close()
-		
+		"""Close once everything queued so far has been written."""
+		with self._sendLock:
+			self._closeRequested = True
+			if not self._watching:
+				self._closeNow()
+
+	def abort(self):
+		"""Close at once, throwing away whatever is still queued."""
+		with self._sendLock:
+			self._closeRequested = True
+			if self._watching:
+				self._watching = False
+				self._writer.callSoon(self._writer.unwatchWrite, self._socket)
+			self._closeNow()
+
+	def _overflow(self):
+		# Called with the send lock held when the peer has fallen too far behind
+		self.droppedMessages += 1
+		if self.overflowPolicy == 'disconnect':
+			# Throw away the backlog and let the receive side see the hang up
+			self._abandon()
+			try:
+				self._socket.shutdown(socketlib.SHUT_RDWR)
+			except OSError:
+				pass
+
+	def _abandon(self):
+		self._broken = True
+		self._outbound.clear()
+		self.queuedBytes = 0
+		self._drained.notify_all()
+
+	def _flush(self):
+		# Write as much as the kernel takes without blocking, send lock held
+		outbound = self._outbound
+		while outbound:
+			try:
+				if len(outbound) == 1 or not _sendmsg:
+					sent = self._socket.send(outbound[0])
+				else:
+					# Gather every queued frame into a single writev style call
+					sent = self._socket.sendmsg(list(itertools.islice(outbound, _IOV_MAX)))
+			except BlockingIOError:
+				return
+			except OSError:
+				# The peer is gone, its own receive loop will clean up
+				self._abandon()
+				return
+			self.bytesSent += sent
+			self.queuedBytes -= sent
+			if self.metrics is not None:
+				self.metrics.bytesOut.inc(sent)
+
+			# Retire the frames that went out whole
+			while sent:
+				length = len(outbound[0])
+				if sent < length:
+					# Partial write, keep the rest without copying it
+					outbound[0] = memoryview(outbound[0])[sent:]
+					return
+				outbound.popleft()
+				sent -= length
+
+	def _onWritable(self, socket):
+		# Runs on the writer loop while the queue is non-empty
+		with self._sendLock:
+			self._flush()
+			if self._outbound:
+				return
+			self._watching = False
+			self._writer.unwatchWrite(self._socket)
+			self._drained.notify_all()
+			if self._closeRequested:
+				self._closeNow()
+
+	def _closeNow(self):
+		if not self._closed:
+			self._closed = True
+			self._abandon()
+			self._socket.close()
+
+
+# Frames handed to one sendmsg call, well under any platform's IOV_MAX
+_IOV_MAX = 512
+_sendmsg = hasattr(socketlib.socket, 'sendmsg')
+
+# Errors of accept() that only concern the connection it was taking
+_ACCEPT_RETRY = (errno.ECONNABORTED, errno.EPROTO, errno.EPERM)
+
+def _reserveDescriptor():
+	"""A file descriptor to close when the process runs out of them, None if there is none left."""
+	try:
+		return open(os.devnull, 'rb')
+	except OSError:
+		return None
+
+_writer = None
+_writerLock = threading.Lock()
+
+def _sharedWriter():
+	"""The EventLoop flushing sockets that are not owned by a selector server."""
+	global _writer
+	with _writerLock:
+		if _writer is None:
+			_writer = EventLoop()
+			threading.Thread(target = _writer.run, args = (lambda: True,), daemon = True).start()
+	return _writer
+
+
+# poll() needs no file descriptor of its own, unlike epoll, so it suits one waiter per thread
+_Poller = getattr(selectors, 'PollSelector', selectors.SelectSelector)
+
+
+class EventLoop():
+	"""
+	A selectors based loop multiplexing many sockets on a single thread.
+	"""
+
+	def __init__(self):
+		self._selector = selectors.DefaultSelector()
+		# Read and write handlers per registered socket
+		self._handlers = {}
+		# Calls scheduled from other threads
+		self._calls = collections.deque()
+		# Self-pipe so other threads can wake the loop up
+		self._wakeReader, self._wakeWriter = socketlib.socketpair()
+		self._wakeReader.setblocking(False)
+		self._wakeWriter.setblocking(False)
+		self.watchRead(self._wakeReader, self._onWake)
+
+	def _update(self, socket, handlers):
+		# Work out the events we still want for this socket
+		events = 0
+		if handlers[0] is not None:
+			events |= selectors.EVENT_READ
+		if handlers[1] is not None:
+			events |= selectors.EVENT_WRITE
+
+		registered = socket in self._handlers
+		if events == 0:
+			if registered:
+				del self._handlers[socket]
+				try:
+					self._selector.unregister(socket)
+				except (KeyError, ValueError, OSError):
+					pass
+		elif registered:
+			self._selector.modify(socket, events, handlers)
+		else:
+			self._handlers[socket] = handlers
+			self._selector.register(socket, events, handlers)
+
+	def watchRead(self, socket, handler):
+		"""Call handler(socket) whenever the socket is readable."""
+		handlers = self._handlers.get(socket, [None, None])
+		handlers[0] = handler
+		self._update(socket, handlers)
+
+	def watchWrite(self, socket, handler):
+		"""Call handler(socket) whenever the socket is writable."""
+		handlers = self._handlers.get(socket, [None, None])
+		handlers[1] = handler
+		self._update(socket, handlers)
+
+	def unwatchRead(self, socket):
+		handlers = self._handlers.get(socket)
+		if handlers is not None:
+			handlers[0] = None
+			self._update(socket, handlers)
+
+	def unwatchWrite(self, socket):
+		handlers = self._handlers.get(socket)
+		if handlers is not None:
+			handlers[1] = None
+			self._update(socket, handlers)
+
+	def callSoon(self, function, *args):
+		"""Run function(*args) on the loop thread. Safe from any thread."""
+		self._calls.append((function, args))
+		self.wake()
+
+	def wake(self):
+		"""Interrupt a blocking select() from another thread."""
+		try:
+			self._wakeWriter.send(b'\0')
+		except OSError:
+			# The pipe is full, so a wake up is already pending
+			pass
+
+	def _onWake(self, socket):
+		try:
+			while self._wakeReader.recv(4096):
+				pass
+		except OSError:
+			pass
+		while self._calls:
+			(function, args) = self._calls.popleft()
+			function(*args)
+
+	def runOnce(self, timeout=None):
+		"""Wait for events at most timeout seconds and dispatch them."""
+		for (key, mask) in self._selector.select(timeout):
+			handlers = key.data
+			if mask & selectors.EVENT_READ and handlers[0] is not None:
+				handlers[0](key.fileobj)
+			if mask & selectors.EVENT_WRITE and handlers[1] is not None:
+				handlers[1](key.fileobj)
+
+	def run(self, isRunning, timeout=1):
+		"""Dispatch events for as long as isRunning() holds."""
+		while isRunning():
+			self.runOnce(timeout)
+
+	def close(self):
+		self._selector.close()
+		self._wakeReader.close()
+		self._wakeWriter.close()
+
+
+class TokenBucket():
+	"""
+	Allows `rate` events a second on average, in bursts of up to `burst`.
+
+	Refilled lazily when taken from, so idle buckets cost nothing. Not locked,
+	share one between threads under a lock of your own.
+	"""
+
+	__slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+	def __init__(self, rate, burst=None):
+		self.rate = rate
+		self.burst = burst if burst is not None else rate
+		self.tokens = self.burst
+		self.stamp = time.monotonic()
+
+	def take(self, now=None, amount=1):
+		"""Take amount tokens if there are that many, returns whether there were."""
+		if now is None:
+			now = time.monotonic()
+		tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+		if tokens < amount:
+			self.tokens = tokens
+			return False
+		self.tokens = tokens - amount
+		return True
+
+	def full(self, now=None):
+		"""Whether the bucket has refilled, making it no different from a new one."""
+		if now is None:
+			now = time.monotonic()
+		return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class TimerWheel():
+	"""
+	A hashed timer wheel, `slots` buckets each `tick` seconds wide.
+
+	Scheduling and cancelling are O(1) however many timers there are, and
+	advancing only visits the buckets of the ticks that went by. A timer more
+	than one turn of the wheel away counts down the turns it still has to
+	wait. Timers expire on the first tick at or after their delay.
+	"""
+
+	def __init__(self, tick=1, slots=256):
+		self.tick = tick
+		self._lock = threading.Lock()
+		# Each bucket maps its keys to the turns they have left
+		self._slots = [{} for i in range(slots)]
+		# key = timer key, value = its bucket
+		self._where = {}
+		self._current = 0
+		self._due = time.monotonic() + tick
+
+	def schedule(self, key, delay):
+		"""Expire key after delay seconds, replacing any timer it already had."""
+		ticks = max(1, int(-(-delay // self.tick)))
+		with self._lock:
+			self._cancel(key)
+			slot = self._slots[(self._current + ticks) % len(self._slots)]
+			slot[key] = (ticks - 1) // len(self._slots)
+			self._where[key] = slot
+
+	def cancel(self, key):
+		"""Forget the timer of key, if it has one."""
+		with self._lock:
+			self._cancel(key)
+
+	def _cancel(self, key):
+		# Called with the lock held
+		slot = self._where.pop(key, None)
+		if slot is not None:
+			del slot[key]
+
+	def advance(self, now=None):
+		"""Turn the wheel up to now, returns the keys whose timers expired."""
+		if now is None:
+			now = time.monotonic()
+		expired = []
+		if now < self._due:
+			return expired
+		with self._lock:
+			while self._due <= now:
+				self._due += self.tick
+				self._current += 1
+				slot = self._slots[self._current % len(self._slots)]
+				for (key, turns) in list(slot.items()):
+					if turns:
+						slot[key] = turns - 1
+					else:
+						del slot[key]
+						del self._where[key]
+						expired.append(key)
+		return expired
+
+	def __len__(self):
+		return len(self._where)
+
+
+class Command():
+	"""A /command line parsed once, into its lower cased name and the words after it."""
+
+	__slots__ = ('name', 'args')
+
+	def __init__(self, line):
+		words = line[1:].split()
+		self.name = words[0].lower() if words else ''
+		self.args = words[1:]
+
+
+def command(*names):
+	"""
+	Register a method of a Receiver subclass as the handler of /name, for
+	each of names. It is looked up in handlers and called as
+	handler(self, socket, command) with a Command.
+	"""
+	def register(handler):
+		handler.commandNames = names
+		return handler
+	return register
+
 
 class Receiver():
 	"""
 	A class for receiving newline delimited text commands on a socket.
 	"""
 
+	# key = command name, value = the method registered for it with @command
+	handlers = {}
+
+	def __init_subclass__(cls, **kwargs):
+		# Collect the @command handlers of each subclass on top of the inherited ones,
+		# from every base so mixins are merged too, nearer bases winning
+		super().__init_subclass__(**kwargs)
+		handlers = {}
+		for base in reversed(cls.__mro__[1:]):
+			handlers.update(vars(base).get('handlers', {}))
+		cls.handlers = handlers
+		for handler in vars(cls).values():
+			for name in getattr(handler, 'commandNames', ()):
+				cls.handlers[name] = handler
+
 	def __init__(self):
-		# Protect access
+		# Protect access to the running flag. Callbacks are not serialised,
+		# so onConnect/onMessage/onDisconnect must guard their own state.
 		self._lock = threading.RLock()
 		self._running = True
+		# Pings awaiting their pong, key = token, value = event
+		self._pings = {}
+		self._tokens = itertools.count()
+		# Readable once a server stops, and when its connections must be flushed by
+		self._stopReader = None
+		self._deadline = None
+
+	# Bytes queued for one slow peer before its overflowPolicy applies
+	highWaterMark = 1 << 20
+	# 'drop' the message that does not fit, or 'disconnect' the peer
+	overflowPolicy = 'disconnect'
+	# Bytes read per recv_into call
+	receiveBufferSize = 1 << 16
+	# Longest message accepted, a peer sending more without a new-line is dropped
+	maxLineLength = 1 << 16
+	# Protocols offered to a peer whose first line is "/protocol <name>"
+	protocols = ()
+	# Shortest frame a compressed connection deflates. The window shared with
+	# earlier frames shrinks even short chat lines, only the tiniest gain nothing
+	compressThreshold = 32
+	# Write sends at once when a connection has nothing queued. Otherwise the
+	# writer loop does every write, batching whatever was queued meanwhile.
+	writeThrough = True
+	# A Metrics collecting traffic counters, see instrument()
+	metrics = None
+	# (rate, burst) of messages a connection may send, beyond it onThrottled gets them instead
+	rateLimit = None
+	# A Capture recording the inbound traffic, see record()
+	capture = None
+
+	def instrument(self, metrics):
+		"""Record accepts, traffic and the time spent in onMessage in metrics."""
+		self.metrics = metrics
+		self.onMessage = metrics.timed(self.onMessage)
+
+	def record(self, capture):
+		"""Write every connect, message handed to onMessage and disconnect to capture."""
+		self.capture = capture
+		self.onMessage = capture.wrap(self.onMessage)
 
 	# 인스턴스가 호출될때 호출되는 함수
 	def __call__(self, socket):
 		"""Called for a connection."""
-		# Set timeout on socket operations
-		socket.settimeout(1)
+		self._serve(self._connect(socket))
 
+	def _serve(self, wrappedSocket):
+		"""Receive on a connection from the calling thread until it closes."""
+		socket = wrappedSocket._socket
 
-		# Wrap socket for events
-		wrappedSocket = Socket(socket)
+		# The socket never blocks, so wait for data with a timeout instead
+		poller = _Poller()
+		poller.register(socket, selectors.EVENT_READ)
+		# Wakes us as soon as the server stops
+		if self._stopReader is not None:
+			poller.register(self._stopReader, selectors.EVENT_READ)
+		buffer = memoryview(bytearray(self.receiveBufferSize))
 		
-		# Store the unprocessed data
-		stored = ''
-		chunk = ''
+		# Loop so long as the receiver is still running
+		try:
+			while self.isRunning():
+				if not poller.select(1) or not self.isRunning():
+					continue
+				try:
+					received = socket.recv_into(buffer)
+				except (BlockingIOError, InterruptedError):
+					continue
+				except OSError:
+					break
+
+				# Nothing received means disconnect, otherwise process every complete message
+				if not received or not self._receive(wrappedSocket, buffer[:received]):
+					break
+		finally:
+			# A handler that raised still gets its connection closed and counted off
+			poller.close()
+
+			# A stopping server lets the peer have what is queued first
+			if not self.isRunning() and self._deadline is not None:
+				self.onShutdown(wrappedSocket)
+				if not wrappedSocket.flush(max(0, self._deadline - time.monotonic())):
+					wrappedSocket.abort()
+
+			# On disconnect!
+			self._disconnect(wrappedSocket)
+			
+			# On join!
+			self.onJoin()
+
+	def _connect(self, socket, writer=None):
+		"""Wrap a freshly connected socket and fire onConnect."""
+		wrappedSocket = Socket(socket, writer, self.highWaterMark, self.overflowPolicy, self.metrics)
+		wrappedSocket.writeThrough = self.writeThrough
 		
+		# Store the unprocessed data, and how much of it holds no new-line
+		wrappedSocket._stored = bytearray()
+		wrappedSocket._scanned = 0
+		# 'request' while the peer's first line may ask for another protocol,
+		# 'reply' while waiting for the answer to our own request
+		wrappedSocket._negotiating = 'request' if self.protocols else None
+		self._track(wrappedSocket)
+
 		# On connect!
-		self._lock.acquire()
 		self.onConnect(wrappedSocket)
-		self._lock.release()
+		return wrappedSocket
+
+	def _track(self, wrappedSocket):
+		"""Start the rate limit, idle clock, capture and metrics of a connection, whatever drives it."""
+		# When the peer last sent anything, and when it was pinged for going quiet
+		wrappedSocket.lastReceived = time.monotonic()
+		wrappedSocket._heartbeat = None
+		wrappedSocket._bucket = TokenBucket(*self.rateLimit) if self.rateLimit is not None else None
+		# The connection's number in the capture
+		wrappedSocket._captured = self.capture.connect() if self.capture is not None else None
 		
-		# Loop so long as the receiver is still running
-		while self.isRunning():
-			# Take everything up to the first newline of the stored data
-			(message, sep, rest) = stored.partition('\n')
-			if sep == '': # If no newline is found, store more data...
-				while self.isRunning():
-					try:
-						chunk = ''
-						chunk = socket.recv(1024).decode() 
-						stored += chunk
-						break
-					except socketlib.timeout:
-						pass
-					except:
-						print('EXCEPTION')
-				
-				# Empty chunk means disconnect
-				if chunk == '':
-					break;
+		if self.metrics is not None:
+			self.metrics.connections.inc()
+
+	def _receive(self, wrappedSocket, data):
+		"""Feed received bytes, returns False once the connection should close."""
+		stored = wrappedSocket._stored
+		if wrappedSocket.deflate is not None:
+			inflated = wrappedSocket.deflate.unpack(data)
+			if inflated is None:
+				return False
+			stored += inflated
+		else:
+			stored += data
+		wrappedSocket.lastReceived = time.monotonic()
+		if self.metrics is not None:
+			self.metrics.bytesIn.inc(len(data))
+		if wrappedSocket.codec is not TEXT_CODEC:
+			return self._receiveFrames(wrappedSocket)
 
+		# A protocol switch takes effect right after its line, so take lines
+		# one at a time until it is settled
+		while wrappedSocket._negotiating:
+			end = stored.find(b'\n')
+			if end == -1:
+				break
+			message = stored[:end].decode(errors = 'replace')
+			del stored[:end + 1]
+			wrappedSocket._scanned = 0
+			if message.startswith('/protocol '):
+				wrappedSocket._negotiating = None
+				self._negotiate(wrappedSocket, message.split()[1:])
+				if wrappedSocket.deflate is not None and stored:
+					# Whatever followed the switch was already compressed
+					inflated = wrappedSocket.deflate.unpack(bytes(stored))
+					if inflated is None:
+						return False
+					stored[:] = inflated
+				if wrappedSocket.codec is not TEXT_CODEC:
+					return self._receiveFrames(wrappedSocket)
 				continue
-			else: # ...otherwise store the rest
-				
-				stored = rest			
+			if wrappedSocket._negotiating == 'request':
+				wrappedSocket._negotiating = None
+			if len(message) > self.maxLineLength or not self.isRunning():
+				return False
+			if not self._admit(wrappedSocket, message):
+				if not self._throttled(wrappedSocket, message):
+					return False
+			elif message.startswith(_CONTROL):
+				self._control(wrappedSocket, PING if message[2] == 'i' else PONG, message[6:])
+			elif not self.onMessage(wrappedSocket, message):
+				return False
+
+		# Only the bytes that just arrived can hold a new-line
+		last = stored.rfind(b'\n', wrappedSocket._scanned)
+		if last == -1:
+			wrappedSocket._scanned = len(stored)
+			return len(stored) <= self.maxLineLength
+
+		# Decode every complete line in one pass, a new-line byte never
+		# splits a UTF-8 character, then drop the consumed prefix once
+		with memoryview(stored) as view:
+			messages = str(view[:last], 'utf-8', 'replace').split('\n')
+		del stored[:last + 1]
+		wrappedSocket._scanned = len(stored)
+
+		for message in messages:
+			if len(message) > self.maxLineLength or not self.isRunning():
+				return False
+			# Over the rate limit, dropped before it is dispatched. Pings count too,
+			# or they could be sent endlessly to have the server echo them back
+			if not self._admit(wrappedSocket, message):
+				if not self._throttled(wrappedSocket, message):
+					return False
+			# Pings are answered here
+			elif message.startswith(_CONTROL):
+				self._control(wrappedSocket, PING if message[2] == 'i' else PONG, message[6:])
 			# Process the command
-			self._lock.acquire()
-			success = self.onMessage(wrappedSocket, message)
-			self._lock.release()
-			
-			if not success:
-				break;
+			elif not self.onMessage(wrappedSocket, message):
+				return False
+		return len(stored) <= self.maxLineLength
 
-		# On disconnect!
-		self._lock.acquire()
+	def _receiveFrames(self, wrappedSocket):
+		"""Dispatch every complete binary frame, returns False once the connection should close."""
+		stored = wrappedSocket._stored
+		header = BinaryCodec.header
+		offset = 0
+		view = memoryview(stored)
+		try:
+			while len(stored) - offset >= header.size:
+				(length, kind, senderLength, targetLength) = header.unpack_from(stored, offset)
+				if length < 5 + senderLength + targetLength or length > self.maxLineLength:
+					return False
+				end = offset + 4 + length
+				if end > len(stored):
+					break
+				start = offset + header.size
+				middle = start + senderLength
+				sender = str(view[start:middle], 'utf-8', 'replace')
+				target = str(view[middle:middle + targetLength], 'utf-8', 'replace')
+				body = str(view[middle + targetLength:end], 'utf-8', 'replace')
+				offset = end
+				if not self.isRunning():
+					return False
+				elif not self._admit(wrappedSocket, body):
+					if not self._throttled(wrappedSocket, body):
+						return False
+				elif kind == PING or kind == PONG:
+					self._control(wrappedSocket, kind, body)
+				elif not self.onFrame(wrappedSocket, kind, body, sender, target):
+					return False
+		finally:
+			view.release()
+		del stored[:offset]
+		return True
+
+	def _admit(self, wrappedSocket, message):
+		"""Whether a message is within the connection's rate limit."""
+		bucket = wrappedSocket._bucket
+		# Received just now, so the receive time does for the refill
+		return bucket is None or bucket.take(wrappedSocket.lastReceived)
+
+	def _throttled(self, wrappedSocket, message):
+		if self.metrics is not None:
+			self.metrics.throttled.inc(value = 'connection')
+		return self.onThrottled(wrappedSocket, message)
+
+	def _control(self, wrappedSocket, kind, token):
+		"""Answer a ping straight away, or pass a pong on to onPong."""
+		if kind == PING:
+			wrappedSocket.sendMessage(PONG, token)
+		else:
+			self.onPong(wrappedSocket, token)
+
+	def _negotiate(self, wrappedSocket, options):
+		"""
+		Switch to the first protocol in options that is offered, and compress
+		the connection if options hold DEFLATE and that is offered too,
+		answering the peer with what was chosen.
+		"""
+		options = [option for option in options if option in self.protocols]
+		codec = next((CODECS[option] for option in options if option in CODECS), TEXT_CODEC)
+		deflate = DeflateStream(self.compressThreshold) if DEFLATE in options else None
+		reply = '/protocol ' + codec.name + (' ' + DEFLATE if deflate is not None else '')
+		wrappedSocket._switch(TEXT_CODEC.line(reply.encode()), codec, deflate)
+
+	def broadcast(self, sockets, message, exclude=None):
+		"""Send one line to many sockets, framing it only once per protocol."""
+		if isinstance(message, bytes):
+			message = message.decode(errors = 'replace')
+		self.broadcastMessage(sockets, TEXT, message, exclude = exclude)
+
+	def broadcastMessage(self, sockets, kind, body, sender='', target='', exclude=None, frames=None):
+		"""
+		Send one message to many sockets, encoding it only once per protocol.
+		frames is the encoding cache to use, as returned by History.append().
+		"""
+		if frames is None:
+			frames = {}
+		for socket in sockets:
+			if socket is not exclude:
+				socket.sendMessage(kind, body, sender, target, frames)
+
+	def _disconnect(self, wrappedSocket):
+		"""Fire onDisconnect and release the underlying socket."""
 		self.onDisconnect(wrappedSocket)		
-		self._lock.release()
-		socket.close()
-		del socket
-		
-		# On join!
-		self.onJoin()
+		wrappedSocket.close()
+		self._untrack(wrappedSocket)
+
+	def _untrack(self, wrappedSocket):
+		"""Record the end of a connection started with _track."""
+		if self.capture is not None:
+			self.capture.disconnect(wrappedSocket._captured)
+		if self.metrics is not None:
+			self.metrics.connections.dec()
 			
 	def stop(self):
 		"""Stop this receiver."""
@@ -105,10 +983,8 @@ class Receiver():
 		
 	def isRunning(self):
 		"""Is this receiver still running?"""
-		self._lock.acquire()
-		running = self._running
-		self._lock.release()
-		return running
+		# A single attribute read is atomic, so no lock is needed on this hot path
+		return self._running
 		
 	def onConnect(self, socket):
 		pass
@@ -116,9 +992,25 @@ class Receiver():
 	def onMessage(self, socket, message):
 		pass
 
+	def onFrame(self, socket, kind, body, sender, target):
+		"""A binary frame arrived. Plain lines go to onMessage as they are, other kinds rendered."""
+		if kind != TEXT:
+			body = render(kind, body, sender, target)
+		return self.onMessage(socket, body)
+
+	def onPong(self, socket, token):
+		pass
+
+	def onThrottled(self, socket, message):
+		"""A message over rateLimit was dropped, return False to disconnect the peer."""
+		return True
+
 	def onDisconnect(self, socket):
 		pass
 
+	def onShutdown(self, socket):
+		pass
+
 	def onJoin(self):
 		pass
 
@@ -126,9 +1018,78 @@ class Receiver():
 		
 class Server(Receiver):
 
-	def start(self, ip, port):
+	# Clients may switch to length prefixed frames, and to compressing them
+	protocols = ('binary', DEFLATE)
+	# Seconds a connection may stay silent before it is pinged, None to never check
+	idleTimeout = None
+	# Seconds a pinged connection has to send anything back before it is dropped
+	heartbeatTimeout = 10
+	# Resolution of both, in seconds
+	timerTick = 1
+	# Seconds a stopping server waits for its connections to take what is queued
+	drainTimeout = 2
+	# Connections the kernel queues until they are accepted, capped by the system's somaxconn
+	backlog = socketlib.SOMAXCONN
+	# Connections served at once, beyond it new ones get rejectMessage and are closed. None for no limit
+	maxConnections = None
+	rejectMessage = "Server is full, please try again later."
+	# Connections taken off the backlog per wakeup at most, so a storm of them
+	# cannot hold up the connections already open for long
+	acceptBatch = 512
+	# Seconds accepting pauses for when the process runs out of file descriptors
+	acceptPause = 1
+
+	def start(self, ip, port, backend='thread', loops=1, reusePort=False):
+		"""
+		Listen on (ip, port) until stopped.
+
+		backend is either 'thread', running one thread per connection, or
+		'selector', multiplexing every connection over `loops` event loops.
+		With reusePort several processes may listen on the same port and the
+		kernel spreads connections between them. A port of None makes ip the
+		path of a Unix domain socket instead.
+		"""
 		# Set up server socket
+		if port is None:
+			serversocket = socketlib.socket(socketlib.AF_UNIX, socketlib.SOCK_STREAM)
+			serversocket.bind(ip)
+		else:
+			serversocket = self._listenInet(ip, port, reusePort)
+
+		# bind가 끝나고 나면 listen하는 단계가 필요합니다. 이는 상대방의 접속을 기다리는 단계로 넘어가겠단 의미.
+		# A whole reconnect storm waits in the backlog instead of being refused
+		serversocket.listen(self.backlog)
+
+		serversocket.setblocking(False)
+		# Connections open or being opened, against maxConnections
+		self._open = 0
+		# When accepting resumes, None unless paused for lack of file descriptors
+		self._pausedUntil = None
+		# Held back so a connection can still be accepted and turned away once the others run out
+		self._spare = _reserveDescriptor()
+		# One wheel tracks the deadlines of every connection
+		self._timers = TimerWheel(self.timerTick) if self.idleTimeout else None
+		# Left readable by stop(), so every thread waiting on it wakes at once
+		self._stopReader, self._stopWriter = socketlib.socketpair()
+		# On start!
+		# server.py 파일에서 overriding 해서 쓰고있다.
+		# 그냥 서버에 연결되었다고 프린트해주는거.
+		self.onStart()
+
+		if backend == 'selector':
+			self._serveSelector(serversocket, loops)
+		else:
+			self._serveThreads(serversocket)
+		serversocket.close()
+		self._stopReader.close()
+		self._stopWriter.close()
+		if self._spare is not None:
+			self._spare.close()
+
+		# On stop!
+		self.onStop()
 
+	def _listenInet(self, ip, port, reusePort):
 		# 소캣을 객체를 생성, 이 때, 인자로 두 가지를 입력해야 하는데, 첫번째는 어드레스 패밀리(AF: Address Family)고, 두번째는 소켓 타입.
 		serversocket = socketlib.socket(socketlib.AF_INET, socketlib.SOCK_STREAM)
 
@@ -139,43 +1100,286 @@ class Server(Receiver):
 		# 이렇게 하면 다른 프로세스가 해당 포트를 기다리는 동안에 시간을 절약할 수 있음.
 		serversocket.setsockopt(socketlib.SOL_SOCKET, socketlib.SO_REUSEADDR, 1)
 
+		# Let worker processes bind the same port, each with its own accept queue
+		if reusePort:
+			serversocket.setsockopt(socketlib.SOL_SOCKET, socketlib.SO_REUSEPORT, 1)
+
 		# 생성된 소켓의 번호와 실제 어드레스 패밀리를 연결해주는 것.
 		# 소켓과 AF를 연결하는 과정이라 하였으므로, 이 인자는 어드레스 패밀리가 된다. 앞부분은 ip, 뒷부분은 포트로 (ip, port) 형식으로 한 쌍으로 구성된 튜플이 곧 어드레스 패밀리.
 		serversocket.bind((ip, int(port)))
+		return serversocket
 
-		# bind가 끝나고 나면 listen하는 단계가 필요합니다. 이는 상대방의 접속을 기다리는 단계로 넘어가겠단 의미.
-		# isten()안에 인자로 숫자 10이 입력되어 있는데, 이는 해당 소켓이 총 몇개의 동시접속까지를 허용할 것이냐는 이야기다.
-		serversocket.listen(10)
-
-		serversocket.settimeout(1)
-		# On start!
-		# server.py 파일에서 overriding 해서 쓰고있다.
-		# 그냥 서버에 연결되었다고 프린트해주는거.
-		self.onStart()
+	def _serveThreads(self, serversocket):
+		# Threads of the open connections, each takes itself off when it is done
+		self._threads = set()
+		poller = _Poller()
+		poller.register(serversocket, selectors.EVENT_READ)
+		poller.register(self._stopReader, selectors.EVENT_READ)
 
 		# Main connection loop
-		threads = []
 		while self.isRunning():
+			timeout = None if self._timers is None else self.timerTick
+			if self._pausedUntil is not None:
+				remaining = max(0, self._pausedUntil - time.monotonic())
+				timeout = remaining if timeout is None else min(timeout, remaining)
+			poller.select(timeout)
+			if self._pausedUntil is None:
+				for socket in self._acceptAll(serversocket):
+					# target은 실제로 스레드가 실행할 함수를 입력하면되고, 그 함수에게 전달할 인자를 args에 입력하시면 된다.
+					# 여기서는 self를 호출하고, 거기에 인자로 소켓을 넘겨준다.
+					# self객체를 호출했으니, 호출함수인 receiver 클래스 안에 __call__ 함수가 호출된다.
+					thread = threading.Thread(target = self._runThread, args = (socket,), daemon = True)
+					with self._lock:
+						self._threads.add(thread)
+					thread.start()
+				# Out of file descriptors, stop listening until some are freed
+				if self._pausedUntil is not None:
+					poller.unregister(serversocket)
+			elif time.monotonic() >= self._pausedUntil:
+				self._pausedUntil = None
+				poller.register(serversocket, selectors.EVENT_READ)
+			if self._timers is not None:
+				self._checkIdle()
+		poller.close()
+
+		# Every connection flushes on its own thread, so they all finish by the deadline
+		with self._lock:
+			threads = list(self._threads)
+		for thread in threads:
+			thread.join(max(0, self._deadline + 1 - time.monotonic()))
+
+	def _runThread(self, socket):
+		try:
+			self(socket)
+		finally:
+			with self._lock:
+				self._threads.discard(threading.current_thread())
+
+	def _serveSelector(self, serversocket, loops):
+		# One event loop on this thread plus any extra loops on their own threads
+		self._loops = [EventLoop() for i in range(max(1, loops))]
+		for loop in self._loops:
+			# Each loop reads every connection into one shared buffer
+			loop.buffer = memoryview(bytearray(self.receiveBufferSize))
+		self._nextLoop = itertools.cycle(self._loops)
+		self._connections = {}
+		threads = []
+		for loop in self._loops[1:]:
+			thread = threading.Thread(target = loop.run, args = (self.isRunning,))
+			threads.append(thread)
+			thread.start()
+
+		serversocket.setblocking(False)
+		mainLoop = self._loops[0]
+		mainLoop.watchRead(serversocket, self._onAcceptable)
+		try:
+			if self._timers is None:
+				mainLoop.run(self.isRunning)
+			while self.isRunning():
+				mainLoop.runOnce(self.timerTick)
+				self._checkIdle()
+		finally:
+			if self._deadline is None:
+				self.stop()
+			mainLoop.unwatchRead(serversocket)
+			while len(threads):
+				threads.pop().join()
+			# Every loop has finished, so say goodbye and flush what is left from here
+			connections = list(self._connections.items())
+			for (wrappedSocket, loop) in connections:
+				self.onShutdown(wrappedSocket)
+			self._drain([wrappedSocket for (wrappedSocket, loop) in connections])
+			for (wrappedSocket, loop) in connections:
+				self._drop(loop, wrappedSocket)
+				wrappedSocket.abort()
+			for loop in self._loops:
+				loop.close()
+
+	def _onAcceptable(self, serversocket):
+		mainLoop = self._loops[0]
+		for socket in self._acceptAll(serversocket):
+			# Hand the connection to the next loop, round robin
+			loop = next(self._nextLoop)
+			if loop is mainLoop:
+				self._adopt(loop, socket)
+			else:
+				loop.callSoon(self._adopt, loop, socket)
+		# Out of file descriptors, stop listening until some are freed
+		if self._pausedUntil is not None:
+			mainLoop.unwatchRead(serversocket)
+			resume = threading.Timer(self.acceptPause, mainLoop.callSoon, (self._resumeAccepting, serversocket))
+			resume.daemon = True
+			resume.start()
+
+	def _resumeAccepting(self, serversocket):
+		self._pausedUntil = None
+		if self.isRunning():
+			self._loops[0].watchRead(serversocket, self._onAcceptable)
+
+	def _acceptAll(self, serversocket):
+		"""Accept the connections waiting in the backlog, up to acceptBatch, returns those admitted."""
+		admitted = []
+		accepted = 0
+		while accepted < self.acceptBatch:
 			try:
 				(socket, address) = serversocket.accept()
-				# target은 실제로 스레드가 실행할 함수를 입력하면되고, 그 함수에게 전달할 인자를 args에 입력하시면 된다.
-				# 여기서는 self를 호출하고, 거기에 인자로 소켓을 넘겨준다.
-				# self객체를 호출했으니, 호출함수인 receiver 클래스 안에 __call__ 함수가 호출된다.
-				thread = threading.Thread(target = self, args = (socket,))
-				threads.append(thread)
-				thread.start()
-				
-			except socketlib.timeout:
+			except (BlockingIOError, InterruptedError):
+				break
+			except OSError as error:
+				# The peer gave up while it waited, the next one may not have
+				if error.errno in _ACCEPT_RETRY:
+					continue
+				# Anything else, running out of file descriptors above all, is
+				# waited out rather than taken as a reason to stop
+				self._pauseAccepting(serversocket)
+				break
+			accepted += 1
+			if self.metrics is not None:
+				self.metrics.accepts.inc()
+			with self._lock:
+				full = self.maxConnections is not None and self._open >= self.maxConnections
+				if not full:
+					self._open += 1
+			if full:
+				self._reject(socket, 'full')
+				continue
+			# Replies are small and written whole, waiting to coalesce them only adds latency
+			if socket.family != getattr(socketlib, 'AF_UNIX', None):
+				socket.setsockopt(socketlib.IPPROTO_TCP, socketlib.TCP_NODELAY, 1)
+			admitted.append(socket)
+		if self.metrics is not None and accepted:
+			self.metrics.acceptBatch.observe(accepted)
+		return admitted
+
+	def _pauseAccepting(self, serversocket):
+		# Give up the spare descriptor to take one connection off the backlog and turn
+		# it away, then take it back, so the peers waiting are not all left hanging
+		if self._spare is not None:
+			self._spare.close()
+			try:
+				(socket, address) = serversocket.accept()
+				self._reject(socket, 'descriptors')
+			except OSError:
 				pass
-			except:
-				self.stop()
+			self._spare = _reserveDescriptor()
+		self._pausedUntil = time.monotonic() + self.acceptPause
+		if self.metrics is not None:
+			self.metrics.acceptPauses.inc()
+
+	def _reject(self, socket, reason):
+		"""Tell a connection there is no room for it and close it."""
+		try:
+			socket.setblocking(False)
+			socket.send(TEXT_CODEC.message(ERROR, self.rejectMessage))
+			socket.shutdown(socketlib.SHUT_WR)
+		except OSError:
+			pass
+		socket.close()
+		if self.metrics is not None:
+			self.metrics.rejected.inc(value = reason)
 
-		# Wait for all threads
-		while len(threads):
-			threads.pop().join()
+	def _adopt(self, loop, socket):
+		# The loop both reports readability and flushes queued sends
+		wrappedSocket = self._connect(socket, loop)
+		self._connections[wrappedSocket] = loop
+		loop.watchRead(socket, lambda socket: self._onReadable(loop, wrappedSocket))
 
-		# On stop!
-		self.onStop()
+	def _onReadable(self, loop, wrappedSocket):
+		try:
+			received = wrappedSocket._socket.recv_into(loop.buffer)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			received = 0
+		# Nothing received means disconnect
+		try:
+			keep = received and self._receive(wrappedSocket, loop.buffer[:received])
+		except Exception:
+			# A handler that raised takes down its own connection, not the loop everyone shares
+			logging.getLogger(__name__).exception("Error handling a message, dropping the connection")
+			keep = False
+		if not keep:
+			self._drop(loop, wrappedSocket)
+
+	def _drop(self, loop, wrappedSocket):
+		loop.unwatchRead(wrappedSocket._socket)
+		del self._connections[wrappedSocket]
+		self._disconnect(wrappedSocket)
+
+	def _drain(self, wrappedSockets):
+		"""Write what is queued for all the connections together, until done or the deadline passes."""
+		poller = _Poller()
+		for wrappedSocket in wrappedSockets:
+			with wrappedSocket._sendLock:
+				wrappedSocket._flush()
+				if wrappedSocket._outbound:
+					poller.register(wrappedSocket._socket, selectors.EVENT_WRITE, wrappedSocket)
+		while poller.get_map():
+			remaining = self._deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			for (key, mask) in poller.select(remaining):
+				wrappedSocket = key.data
+				with wrappedSocket._sendLock:
+					wrappedSocket._flush()
+					if wrappedSocket._outbound:
+						continue
+				poller.unregister(key.fileobj)
+		poller.close()
+
+	def stop(self):
+		"""Stop serving. Every thread and loop wakes at once and connections get drainTimeout to flush."""
+		self._deadline = time.monotonic() + self.drainTimeout
+		Receiver.stop(self)
+		if self._stopReader is not None:
+			try:
+				self._stopWriter.send(b'\0')
+			except OSError:
+				pass
+		for loop in getattr(self, '_loops', ()):
+			loop.wake()
+
+	def _connect(self, socket, writer=None):
+		wrappedSocket = Receiver._connect(self, socket, writer)
+		if self._timers is not None:
+			self._timers.schedule(wrappedSocket, self.idleTimeout)
+		return wrappedSocket
+
+	def _disconnect(self, wrappedSocket):
+		if self._timers is not None:
+			self._timers.cancel(wrappedSocket)
+		Receiver._disconnect(self, wrappedSocket)
+		with self._lock:
+			self._open -= 1
+
+	def _checkIdle(self):
+		"""Ping the connections that went quiet and drop those that stayed quiet since."""
+		now = time.monotonic()
+		for wrappedSocket in self._timers.advance(now):
+			# Already on its way out, its own disconnect cancels nothing now
+			if wrappedSocket._closeRequested or wrappedSocket._broken:
+				continue
+			pinged = wrappedSocket._heartbeat
+			if pinged is not None and wrappedSocket.lastReceived <= pinged:
+				# The receive side sees the hang up and disconnects as usual
+				if self.metrics is not None:
+					self.metrics.evictions.inc()
+				try:
+					wrappedSocket._socket.shutdown(socketlib.SHUT_RDWR)
+				except OSError:
+					pass
+				continue
+			quiet = now - wrappedSocket.lastReceived
+			if quiet < self.idleTimeout:
+				wrappedSocket._heartbeat = None
+				self._timers.schedule(wrappedSocket, self.idleTimeout - quiet)
+			else:
+				# Anything the peer sends, a pong included, counts as an answer
+				wrappedSocket._heartbeat = now
+				wrappedSocket.sendMessage(PING, 'heartbeat')
+				if self.metrics is not None:
+					self.metrics.heartbeats.inc()
+				self._timers.schedule(wrappedSocket, self.heartbeatTimeout)
 
 	def onStart(self):
 		pass
@@ -186,26 +1390,80 @@ class Server(Receiver):
 
 
 class Client(Receiver):
+
+	# Sends only queue, the writer thread drains them in batches
+	writeThrough = False
 	
-	def start(self, ip, port):
-		# Set up server socket
-		self._socket = socketlib.socket(socketlib.AF_INET, socketlib.SOCK_STREAM)
+	def start(self, ip, port, protocol='text', compress=False):
+		"""
+		Connect to (ip, port), a port of None makes ip a Unix domain socket path.
+
+		A protocol other than 'text', or compression, is requested from the
+		server before start returns, the connection stays on plain text if the
+		server does not offer it.
+		"""
+		# Set up server socket, a port of None makes ip a Unix domain socket path
+		if port is None:
+			self._socket = socketlib.socket(socketlib.AF_UNIX, socketlib.SOCK_STREAM)
+			address = ip
+		else:
+			self._socket = socketlib.socket(socketlib.AF_INET, socketlib.SOCK_STREAM)
+			address = (ip, int(port))
 		self._socket.settimeout(1)
-		self._socket.connect((ip, int(port)))
+		self._socket.connect(address)
 
 		# On start!
 		self.onStart()
 
 		# Start listening for incoming messages
-		self._thread = threading.Thread(target = self, args = (self._socket,))
+		self._wrappedSocket = self._connect(self._socket)
+		negotiate = protocol != 'text' or compress
+		if negotiate:
+			# Nothing else is sent until the answer, which switches both directions
+			self._negotiated = threading.Event()
+			self._wrappedSocket._negotiating = 'reply'
+			self._wrappedSocket.send(('/protocol ' + protocol + (' ' + DEFLATE if compress else '')).encode())
+		self._thread = threading.Thread(target = self._serve, args = (self._wrappedSocket,))
 		self._thread.start()
+		if negotiate:
+			self._negotiated.wait(5)
+
+	def _negotiate(self, wrappedSocket, options):
+		# The server's answer to our request
+		codec = CODECS.get(options[0] if options else 'text', TEXT_CODEC)
+		deflate = DeflateStream(self.compressThreshold) if DEFLATE in options else None
+		wrappedSocket._switch(None, codec, deflate)
+		self._negotiated.set()
 		
 	def send(self, message):
-		# Send message to server
-		self._lock.acquire()
-		self._socket.send(message.strip()+b'\n')
-		self._lock.release()
-		time.sleep(0.5)
+		"""Queue message for the server without waiting, returns False if it was refused."""
+		return self._wrappedSocket.send(message)
+
+	def sendLines(self, messages):
+		"""Queue many messages at once, they go out in a single write."""
+		return self._wrappedSocket.sendLines(messages)
+
+	def flush(self, timeout=None):
+		"""Block until everything queued has been written to the socket."""
+		return self._wrappedSocket.flush(timeout)
+
+	def ack(self, timeout=5):
+		"""
+		Block until the server has processed everything sent so far, by
+		pinging it behind those messages. Returns False on timeout.
+		"""
+		token = str(next(self._tokens))
+		answered = self._pings[token] = threading.Event()
+		try:
+			self._wrappedSocket.sendMessage(PING, token)
+			return answered.wait(timeout)
+		finally:
+			del self._pings[token]
+
+	def onPong(self, socket, token):
+		answered = self._pings.get(token)
+		if answered is not None:
+			answered.set()
 
 	def stop(self):
 		# Stop event loop
@@ -226,3 +1484,1293 @@ class Client(Receiver):
 		
 	def onJoin(self):
 		self.stop()
+
+
+
+class PresenceRegistry():
+	"""
+	The connected sockets and the usernames they have claimed, indexed both ways.
+
+	Names are matched case-insensitively but reported as they were claimed.
+	Every operation is O(1) and atomic. The snapshots used for broadcasts are
+	rebuilt lazily, at most once per change, when somebody asks for them.
+	`version` goes up whenever a username is claimed or released.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		# key = socket, value = its username or None
+		self._names = {}
+		# key = casefolded username, value = socket
+		self._owners = {}
+		self._everyone = None
+		self._members = None
+		self._sorted = None
+		self.version = 0
+
+	def connect(self, socket):
+		"""Track a new connection that has no username yet."""
+		with self._lock:
+			self._names[socket] = None
+			self._everyone = None
+
+	def disconnect(self, socket):
+		"""Forget a connection, returns the username it held if any."""
+		with self._lock:
+			name = self._names.pop(socket, None)
+			self._everyone = None
+			if name is not None:
+				del self._owners[name.casefold()]
+				self._changed()
+		return name
+
+	def claim(self, socket, name):
+		"""
+		Give name to socket, releasing its old name when it had one.
+
+		Returns 'set', 'changed', 'same' when socket already holds exactly that
+		name, or 'taken' when another socket holds it.
+		"""
+		key = name.casefold()
+		with self._lock:
+			owner = self._owners.get(key)
+			old = self._names.get(socket)
+			if owner is not None and owner is not socket:
+				return 'taken'
+			if old == name:
+				return 'same'
+			if old is not None:
+				del self._owners[old.casefold()]
+			self._owners[key] = socket
+			self._names[socket] = name
+			self._everyone = None
+			self._changed()
+		return 'set' if old is None else 'changed'
+
+	def _changed(self):
+		# Called with the lock held when the usernames changed
+		self._members = None
+		self._sorted = None
+		self.version += 1
+
+	def lookup(self, name):
+		"""The socket holding name, in any letter case, or None."""
+		return self._owners.get(name.casefold())
+
+	def nameOf(self, socket):
+		return self._names.get(socket)
+
+	def names(self):
+		"""Every claimed username."""
+		return [name for (socket, name) in self.everyone() if name is not None]
+
+	def everyone(self):
+		"""Snapshot of (socket, username or None) for every connection."""
+		everyone = self._everyone
+		if everyone is None:
+			with self._lock:
+				everyone = self._everyone = tuple(self._names.items())
+		return everyone
+
+	def members(self):
+		"""Snapshot of the sockets that have claimed a username."""
+		members = self._members
+		if members is None:
+			with self._lock:
+				members = self._members = tuple(self._owners.values())
+		return members
+
+	def snapshot(self):
+		"""(version, usernames) with the usernames sorted case-insensitively, rebuilt once per version."""
+		snapshot = self._sorted
+		if snapshot is None:
+			with self._lock:
+				names = sorted((name for name in self._names.values() if name is not None), key = str.casefold)
+				snapshot = self._sorted = (self.version, tuple(names))
+		return snapshot
+
+	def __len__(self):
+		return len(self._names)
+
+
+class Room():
+	"""One room's members, and a snapshot of them for broadcasts."""
+
+	__slots__ = ('name', 'members', 'snapshot')
+
+	def __init__(self, name):
+		self.name = name
+		self.members = set()
+		self.snapshot = None
+
+
+class RoomRegistry():
+	"""
+	Rooms and the sockets that joined them, indexed both ways so a socket
+	leaves every room it is in without scanning the others.
+
+	Room names are matched case-insensitively but reported as they were
+	first given, and a room disappears with its last member. Snapshots used
+	for broadcasts are rebuilt lazily, like PresenceRegistry's.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		# key = casefolded room name, value = Room
+		self._rooms = {}
+		# key = socket, value = set of the casefolded names of its rooms
+		self._joined = {}
+
+	def join(self, socket, name):
+		"""Add socket to the room, opening it. Returns (room name, False if it was in already)."""
+		key = name.casefold()
+		with self._lock:
+			room = self._rooms.get(key)
+			if room is None:
+				room = self._rooms[key] = Room(name)
+			if socket in room.members:
+				return (room.name, False)
+			room.members.add(socket)
+			room.snapshot = None
+			self._joined.setdefault(socket, set()).add(key)
+		return (room.name, True)
+
+	def part(self, socket, name):
+		"""Take socket out of the room, returns its name or None if socket was not in it."""
+		with self._lock:
+			return self._remove(socket, name.casefold())
+
+	def leaveAll(self, socket):
+		"""Take socket out of every room it is in, returns their names."""
+		with self._lock:
+			return [self._remove(socket, key) for key in list(self._joined.get(socket, ()))]
+
+	def _remove(self, socket, key):
+		# Called with the lock held
+		room = self._rooms.get(key)
+		if room is None or socket not in room.members:
+			return None
+		room.members.discard(socket)
+		joined = self._joined[socket]
+		joined.discard(key)
+		if not joined:
+			del self._joined[socket]
+		if room.members:
+			room.snapshot = None
+		else:
+			del self._rooms[key]
+		return room.name
+
+	def members(self, name):
+		"""Snapshot of the sockets in the room, empty when there is no such room."""
+		room = self._rooms.get(name.casefold())
+		if room is None:
+			return ()
+		snapshot = room.snapshot
+		if snapshot is None:
+			with self._lock:
+				snapshot = room.snapshot = tuple(room.members)
+		return snapshot
+
+	def rooms(self):
+		"""(name, member count) of every room."""
+		with self._lock:
+			return [(room.name, len(room.members)) for room in self._rooms.values()]
+
+	def roomsOf(self, socket):
+		"""Names of the rooms socket is in."""
+		with self._lock:
+			return [self._rooms[key].name for key in self._joined.get(socket, ())]
+
+	def __len__(self):
+		return len(self._rooms)
+
+
+class History():
+	"""
+	The last `capacity` messages of a channel, kept encoded for each codec
+	they were sent with, so replaying them is one write of a single buffer.
+
+	With a MessageLog every message is also appended to disk, and the
+	history starts from the log's tail so it survives restarts.
+	"""
+
+	def __init__(self, capacity=100, log=None):
+		self.capacity = capacity
+		self.log = log
+		self._lock = threading.Lock()
+		# (kind, body, sender, target, frames) oldest first, the oldest falls off when full
+		self._entries = collections.deque(maxlen = capacity)
+		# key = codec, value = every entry's frame joined, dropped on append
+		self._replays = {}
+		if log is not None:
+			for frame in log.tail(capacity):
+				self._entries.append(BINARY_CODEC.fields(frame) + ({BINARY_CODEC: frame},))
+
+	def append(self, kind, body, sender='', target=''):
+		"""
+		Record a message, returns the frames cache to broadcast it with.
+		Raises ValueError, recording nothing, if sender or target could not
+		be framed for binary clients, as every replay would then fail.
+		"""
+		if max(len(sender.encode()), len(target.encode())) > BINARY_CODEC.maxField:
+			raise ValueError(f"sender and target must fit in {BINARY_CODEC.maxField} bytes")
+		frames = {}
+		with self._lock:
+			if self.log is not None:
+				frames[BINARY_CODEC] = BINARY_CODEC.message(kind, body, sender, target)
+				self.log.append(frames[BINARY_CODEC])
+			self._entries.append((kind, body, sender, target, frames))
+			self._replays.clear()
+		return frames
+
+	def replay(self, socket):
+		"""Send socket the whole history in one frame, returns False if it was refused."""
+		codec = getattr(socket, 'codec', TEXT_CODEC)
+		with self._lock:
+			data = self._replays.get(codec)
+			if data is None:
+				parts = []
+				for (kind, body, sender, target, frames) in self._entries:
+					frame = frames.get(codec)
+					if frame is None:
+						frame = frames[codec] = codec.message(kind, body, sender, target)
+					parts.append(frame)
+				data = self._replays[codec] = b"".join(parts)
+		return socket.sendFrame(data) if data else True
+
+	def __len__(self):
+		return len(self._entries)
+
+
+class MessageLog():
+	"""
+	An append-only log of messages on disk, memory mapped.
+
+	Records are binary protocol frames. The file grows `chunk` bytes at a
+	time and a zero length marks the end of the records. A second file,
+	path + '.idx', holds the offset of every record as 8 native-endian bytes,
+	so the tail is found without reading the log. Records that made it to the
+	log but not to the index are recovered when the log is opened.
+	"""
+
+	def __init__(self, path, chunk=1 << 20):
+		self.path = path
+		self.chunk = chunk
+		self._lock = threading.Lock()
+		self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+		size = os.fstat(self._fd).st_size
+		if size == 0:
+			size = chunk
+			os.ftruncate(self._fd, size)
+		self._map = mmap.mmap(self._fd, size)
+
+		# Offsets of the records, the only part of the log kept in memory
+		self._index = open(path + '.idx', 'a+b')
+		self._index.seek(0)
+		data = self._index.read()
+		self._offsets = array.array('Q')
+		self._offsets.frombytes(data[:len(data) - len(data) % self._offsets.itemsize])
+		# Forget offsets past the records that reached the file
+		while self._offsets and self._length(self._offsets[-1]) == 0:
+			self._offsets.pop()
+		self._end = self._offsets[-1] + 4 + self._length(self._offsets[-1]) if self._offsets else 0
+		recovered = len(self._offsets)
+		while True:
+			length = self._length(self._end)
+			if length == 0:
+				break
+			self._offsets.append(self._end)
+			self._end += 4 + length
+		# Rewrite the index when it did not match the log
+		if len(data) != len(self._offsets) * self._offsets.itemsize:
+			self._index.truncate(0)
+			self._index.write(self._offsets.tobytes())
+			self._index.flush()
+		elif recovered < len(self._offsets):
+			self._index.write(self._offsets[recovered:].tobytes())
+			self._index.flush()
+
+	def _length(self, offset):
+		# Length of the record at offset, 0 past the end of the records
+		if offset + 4 > len(self._map):
+			return 0
+		length = int.from_bytes(self._map[offset:offset + 4], 'big')
+		return length if offset + 4 + length <= len(self._map) else 0
+
+	def append(self, frame):
+		"""Add one binary frame to the end of the log."""
+		with self._lock:
+			end = self._end + len(frame)
+			if end > len(self._map):
+				# Leave a zero length after the last record
+				self._map.resize((end + 4) // self.chunk * self.chunk + self.chunk)
+			self._map[self._end:end] = frame
+			self._offsets.append(self._end)
+			self._index.write(self._offsets[-1:].tobytes())
+			self._end = end
+
+	def read(self, number):
+		"""The frame of the given record, counting from 0."""
+		offset = self._offsets[number]
+		return self._map[offset:offset + 4 + self._length(offset)]
+
+	def tail(self, count):
+		"""The frames of the last count records, oldest first."""
+		with self._lock:
+			return [self.read(number) for number in range(max(0, len(self._offsets) - count), len(self._offsets))]
+
+	def sync(self):
+		"""Write the log and its index through to disk."""
+		with self._lock:
+			self._map.flush()
+			self._index.flush()
+			os.fsync(self._index.fileno())
+
+	def close(self):
+		self.sync()
+		self._map.close()
+		self._index.close()
+		os.close(self._fd)
+
+	def __len__(self):
+		return len(self._offsets)
+
+
+class Mailbox():
+	"""
+	Private messages kept for users who are not connected, in an SQLite database.
+
+	Posted messages wait in memory and are written `batchSize` at a time, or
+	every `interval` seconds by a background thread, each batch in a single
+	transaction, so a busy server does not sync the disk for every message.
+	Whatever was posted within the last interval is lost if the process dies.
+	Each user holds at most `capacity` messages.
+	"""
+
+	def __init__(self, path, capacity=100, batchSize=256, interval=1):
+		self.path = path
+		self.capacity = capacity
+		self.batchSize = batchSize
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(path, check_same_thread = False)
+		# Without the rollback journal a commit only appends to the log, synced on checkpoints
+		self._db.execute('PRAGMA journal_mode=WAL')
+		self._db.execute('PRAGMA synchronous=NORMAL')
+		with self._db:
+			self._db.execute('CREATE TABLE IF NOT EXISTS mail (id INTEGER PRIMARY KEY, recipient TEXT NOT NULL, '
+				'sender TEXT NOT NULL, body TEXT NOT NULL, sent REAL NOT NULL)')
+			self._db.execute('CREATE INDEX IF NOT EXISTS mail_recipient ON mail (recipient, id)')
+		# key = casefolded username, value = messages stored or pending, so most
+		# users are answered without a query
+		self._counts = collections.Counter(dict(self._db.execute('SELECT recipient, COUNT(*) FROM mail GROUP BY recipient')))
+		# (recipient, sender, body, sent) not written yet
+		self._pending = []
+		self._closed = threading.Event()
+		self._writer = threading.Thread(target = self._writeEvery, args = (interval,), daemon = True)
+		self._writer.start()
+
+	def post(self, recipient, sender, body):
+		"""Keep a message for recipient, False if their mailbox is full."""
+		key = recipient.casefold()
+		with self._lock:
+			if self._closed.is_set() or self._counts[key] >= self.capacity:
+				return False
+			self._counts[key] += 1
+			self._pending.append((key, sender, body, time.time()))
+			if len(self._pending) >= self.batchSize:
+				self._write()
+		return True
+
+	def take(self, recipient):
+		"""Remove and return recipient's messages as (sender, body, sent) tuples, oldest first."""
+		key = recipient.casefold()
+		with self._lock:
+			if not self._counts.get(key) or self._closed.is_set():
+				return []
+			self._write()
+			with self._db:
+				messages = self._db.execute('SELECT sender, body, sent FROM mail WHERE recipient = ? ORDER BY id', (key,)).fetchall()
+				self._db.execute('DELETE FROM mail WHERE recipient = ?', (key,))
+			del self._counts[key]
+		return messages
+
+	def _write(self):
+		# Lock held, one transaction for everything pending
+		if self._pending:
+			with self._db:
+				self._db.executemany('INSERT INTO mail (recipient, sender, body, sent) VALUES (?, ?, ?, ?)', self._pending)
+			self._pending.clear()
+
+	def _writeEvery(self, interval):
+		while not self._closed.wait(interval):
+			with self._lock:
+				self._write()
+
+	def flush(self):
+		"""Write every pending message now."""
+		with self._lock:
+			self._write()
+
+	def close(self):
+		with self._lock:
+			if self._closed.is_set():
+				return
+			self._write()
+			self._closed.set()
+			self._db.close()
+		self._writer.join()
+
+	def __len__(self):
+		return sum(self._counts.values())
+
+
+class Capture():
+	"""
+	A binary log of the traffic a server receives, for replaying it later.
+
+	The file starts with `magic`, then holds a record per event: the kind
+	byte, nanoseconds since the capture was opened, the connection number and
+	the length of the message, as big-endian integers, then the message in
+	UTF-8. Connects and disconnects carry no message. Records are buffered
+	and written `bufferSize` bytes at a time, the rest when closed.
+	"""
+
+	magic = b'CHATCAP1'
+	record = struct.Struct('!BQII')
+
+	def __init__(self, path, bufferSize=1 << 16):
+		self.path = path
+		self._lock = threading.Lock()
+		self._file = open(path, 'wb', buffering = bufferSize)
+		self._file.write(self.magic)
+		self._start = time.monotonic_ns()
+		self._connections = itertools.count()
+		self.events = 0
+
+	def connect(self):
+		"""Record a new connection, returns its number."""
+		number = next(self._connections)
+		self._write(CAPTURE_CONNECT, number, b'')
+		return number
+
+	def message(self, number, message):
+		self._write(CAPTURE_MESSAGE, number, message.encode())
+
+	def disconnect(self, number):
+		self._write(CAPTURE_DISCONNECT, number, b'')
+
+	def _write(self, kind, number, data):
+		# Stamped under the lock, so the records are in time order
+		with self._lock:
+			if self._file.closed:
+				return
+			self._file.write(self.record.pack(kind, time.monotonic_ns() - self._start, number, len(data)) + data)
+			self.events += 1
+
+	def wrap(self, onMessage):
+		"""Wrap onMessage to record every call."""
+		message = self.message
+
+		def capturedOnMessage(socket, line):
+			message(socket._captured, line)
+			return onMessage(socket, line)
+		return capturedOnMessage
+
+	def flush(self):
+		with self._lock:
+			self._file.flush()
+
+	def close(self):
+		with self._lock:
+			self._file.close()
+
+
+def readCapture(path):
+	"""Yield (kind, seconds, connection, message) for every event of a Capture, in order."""
+	record = Capture.record
+	with open(path, 'rb') as capture:
+		if capture.read(len(Capture.magic)) != Capture.magic:
+			raise ValueError(f"{path} is not a capture")
+		while True:
+			header = capture.read(record.size)
+			if len(header) < record.size:
+				return
+			(kind, nanoseconds, number, length) = record.unpack(header)
+			data = capture.read(length)
+			# A capture cut short ends with the last whole record
+			if len(data) < length:
+				return
+			yield (kind, nanoseconds / 1e9, number, data.decode(errors = 'replace'))
+
+
+class Counter():
+	"""A monotonically increasing count, optionally split by one label."""
+
+	kind = 'counter'
+
+	def __init__(self, name, help, label=None):
+		self.name = name
+		self.help = help
+		self.label = label
+		self._lock = threading.Lock()
+		# key = label value, or None without a label
+		self._values = {}
+
+	def inc(self, amount=1, value=None):
+		with self._lock:
+			self._values[value] = self._values.get(value, 0) + amount
+
+	def get(self, value=None):
+		return self._values.get(value, 0)
+
+	def samples(self):
+		with self._lock:
+			values = list(self._values.items())
+		if self.label is None:
+			return [(self.name, values[0][1] if values else 0)]
+		return [(f'{self.name}{{{self.label}="{value}"}}', count) for (value, count) in sorted(values)]
+
+
+class Gauge(Counter):
+	"""A value that goes up and down, or is read from function when scraped."""
+
+	kind = 'gauge'
+
+	def __init__(self, name, help, function=None):
+		super(Gauge, self).__init__(name, help)
+		self._function = function
+
+	def dec(self, amount=1):
+		self.inc(-amount)
+
+	def samples(self):
+		if self._function is not None:
+			return [(self.name, self._function())]
+		return Counter.samples(self)
+
+
+class Histogram():
+	"""Observations counted into cumulative buckets, with their sum."""
+
+	kind = 'histogram'
+
+	def __init__(self, name, help, buckets):
+		self.name = name
+		self.help = help
+		self.buckets = sorted(buckets)
+		self._lock = threading.Lock()
+		# One count per bucket, then one for everything above the last
+		self._counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		index = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			self._counts[index] += 1
+			self.sum += value
+			self.count += 1
+
+	def percentile(self, fraction):
+		"""Upper bound of the bucket holding the given fraction of observations."""
+		target = fraction * self.count
+		seen = 0
+		for (bound, count) in zip(self.buckets, self._counts):
+			seen += count
+			if seen >= target:
+				return bound
+		return float('inf')
+
+	def samples(self):
+		with self._lock:
+			counts = list(self._counts)
+			(total, count) = (self.sum, self.count)
+		samples = []
+		cumulative = 0
+		for (bound, bucket) in zip(self.buckets + [float('inf')], counts):
+			cumulative += bucket
+			samples.append((f'{self.name}_bucket{{le="{"+Inf" if bound == float("inf") else bound}"}}', cumulative))
+		return samples + [(f'{self.name}_sum', total), (f'{self.name}_count', count)]
+
+
+class _TimedLock():
+	"""A Lock recording in a Histogram how long contended acquires waited."""
+
+	def __init__(self, histogram):
+		self._lock = threading.Lock()
+		self._histogram = histogram
+
+	def acquire(self, blocking=True, timeout=-1):
+		# Uncontended acquires cost one extra call and are not recorded
+		if self._lock.acquire(False):
+			return True
+		if not blocking:
+			return False
+		start = time.perf_counter()
+		acquired = self._lock.acquire(True, timeout)
+		self._histogram.observe(time.perf_counter() - start)
+		return acquired
+
+	def release(self):
+		self._lock.release()
+
+	def locked(self):
+		return self._lock.locked()
+
+	__enter__ = acquire
+
+	def __exit__(self, *exception):
+		self._lock.release()
+
+
+# Latency buckets in seconds, from 10 microseconds to 10 seconds
+LATENCY_BUCKETS = [1e-05, 2.5e-05, 5e-05, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+	0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+ACCEPT_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+
+
+class Metrics():
+	"""
+	Counters, gauges and histograms for one server, exposed in the Prometheus
+	text format through expose(), serve() or whatever command the server offers.
+
+	Receiver.instrument() records the standard metrics created here, and
+	applications add their own with counter(), gauge() and histogram().
+	"""
+
+	def __init__(self, prefix='chat'):
+		self.prefix = prefix
+		self._metrics = []
+		self.accepts = self.counter('accepts_total', "Connections accepted.")
+		self.connections = self.gauge('connections', "Open connections.")
+		self.bytesIn = self.counter('received_bytes_total', "Bytes received from peers.")
+		self.bytesOut = self.counter('sent_bytes_total', "Bytes written to peers.")
+		self.messages = self.counter('messages_total', "Messages dispatched to onMessage.")
+		self.dispatch = self.histogram('dispatch_seconds', "Time spent in onMessage per message.")
+		self.lockWait = self.histogram('lock_wait_seconds', "Time contended send locks were waited for.")
+		self.heartbeats = self.counter('heartbeats_total', "Pings sent to connections that went quiet.")
+		self.evictions = self.counter('idle_evictions_total', "Connections dropped for not answering a heartbeat.")
+		self.throttled = self.counter('throttled_total', "Messages dropped by rate limits, by limit.", 'limit')
+		self.rejected = self.counter('rejected_total', "Connections turned away on accept, by reason.", 'reason')
+		self.acceptPauses = self.counter('accept_pauses_total', "Times accepting paused for lack of file descriptors.")
+		self.acceptBatch = self.histogram('accept_batch', "Connections accepted per wakeup.", ACCEPT_BUCKETS)
+
+	def _add(self, metric):
+		self._metrics.append(metric)
+		return metric
+
+	def counter(self, name, help, label=None):
+		return self._add(Counter(f'{self.prefix}_{name}', help, label))
+
+	def gauge(self, name, help, function=None):
+		return self._add(Gauge(f'{self.prefix}_{name}', help, function))
+
+	def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+		return self._add(Histogram(f'{self.prefix}_{name}', help, buckets))
+
+	def lock(self):
+		"""A new Lock whose contended acquires are recorded in lockWait."""
+		return _TimedLock(self.lockWait)
+
+	def timed(self, onMessage):
+		"""Wrap onMessage to count and time every call."""
+		messages = self.messages
+		dispatch = self.dispatch
+		clock = time.perf_counter
+
+		def timedOnMessage(socket, message):
+			messages.inc()
+			start = clock()
+			try:
+				return onMessage(socket, message)
+			finally:
+				dispatch.observe(clock() - start)
+		return timedOnMessage
+
+	def expose(self):
+		"""Every metric in the Prometheus text exposition format."""
+		lines = []
+		for metric in self._metrics:
+			lines.append(f'# HELP {metric.name} {metric.help}')
+			lines.append(f'# TYPE {metric.name} {metric.kind}')
+			lines.extend(f'{name} {value}' for (name, value) in metric.samples())
+		return '\n'.join(lines) + '\n'
+
+	def serve(self, ip, port):
+		"""Answer HTTP GETs on (ip, port) with expose(), from a daemon thread."""
+		metrics = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = metrics.expose().encode()
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		server = http.server.ThreadingHTTPServer((ip, int(port)), Handler)
+		server.daemon_threads = True
+		threading.Thread(target = server.serve_forever, daemon = True).start()
+		return server
+
+
+def startLogging(level=logging.INFO, stream=None):
+	"""
+	Send every log record through a queue to a background thread that writes
+	them to stream, stdout by default, so logging never blocks on output.
+	Returns the QueueListener, stop() it to flush what is left.
+	"""
+	records = queue.SimpleQueue()
+	handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+	handler.setFormatter(logging.Formatter('%(message)s'))
+	listener = logging.handlers.QueueListener(records, handler)
+	root = logging.getLogger()
+	root.addHandler(logging.handlers.QueueHandler(records))
+	root.setLevel(level)
+	listener.start()
+	return listener
+
+
+class BusHub(Server):
+	"""
+	Relays newline delimited JSON between the worker processes of one server,
+	or between the servers of a federation when it listens on TCP.
+
+	The hub owns every username claimed on any worker, so claims stay unique
+	across processes, and counts the members of every room. Every worker
+	links to the hub alone, so each message reaches each worker exactly once.
+	Run it with the 'selector' backend so no locking is needed.
+	Requests carry an 'op' and, when the worker waits for an answer, an 'id'
+	that is echoed back as 'reply'.
+	"""
+
+	# Relayed lines are queued and written once per pass of the event loop,
+	# so everything bound for one worker in that pass goes out in one write
+	writeThrough = False
+	# Shared secret a worker has to send in a 'hello' before anything else, None to admit every worker
+	secret = None
+	# A Mailbox keeping private messages for users connected to no worker, None to refuse them
+	mailbox = None
+	# A bus line holds a whole chat line after JSON escaping, or a user's mail, far
+	# longer than the chat's own line limit, and a worker's queue must take the longest
+	maxLineLength = 1 << 26
+	highWaterMark = 1 << 27
+	# Usernames per 'names' reply, and rooms in the 'rooms' reply, the biggest ones
+	namesPage = 1000
+	roomsLimit = 1000
+
+	def onStart(self):
+		self._workers = set()
+		# key = casefolded username, value = (worker socket, username as claimed)
+		self._owners = {}
+		# key = casefolded room name, value = [room name, members on all workers]
+		self._rooms = {}
+		# Goes up whenever a username is claimed or released, so workers can cache the names
+		self._version = 0
+
+	def onConnect(self, socket):
+		socket.names = set()
+		# key = casefolded room name, value = members on this worker
+		socket.rooms = collections.Counter()
+		socket.admitted = self.secret is None
+		self._workers.add(socket)
+
+	def onDisconnect(self, socket):
+		# A worker that went away takes its users with it
+		self._workers.discard(socket)
+		for key in socket.names:
+			del self._owners[key]
+		if socket.names:
+			self._version += 1
+		for (key, count) in list(socket.rooms.items()):
+			self._part(socket, key, count)
+
+	def onMessage(self, socket, message):
+		try:
+			request = json.loads(message)
+			op = request['op']
+		except (ValueError, KeyError, TypeError):
+			# Not a worker speaking the bus protocol
+			return False
+
+		if not socket.admitted:
+			socket.admitted = op == 'hello' and hmac.compare_digest(str(request.get('secret')).encode(), self.secret.encode())
+			return socket.admitted
+
+		if op == 'claim':
+			# Take a name, and give up the old one when it is a rename
+			key = request['name'].casefold()
+			old = request.get('old')
+			# Changing only the letter case of one's own name is fine
+			ok = key not in self._owners or (old is not None and old.casefold() == key and key in socket.names)
+			mail = []
+			if ok:
+				self._release(socket, old)
+				self._owners[key] = (socket, request['name'])
+				socket.names.add(key)
+				self._version += 1
+				# What was kept for the name while nobody had it comes with it
+				if self.mailbox is not None:
+					mail = self.mailbox.take(key)
+			self._reply(socket, request, ok = ok, count = len(self._owners), mail = mail)
+
+		elif op == 'release':
+			self._release(socket, request['name'])
+
+		elif op == 'names':
+			# The names are only sent when they changed since the version the worker has,
+			# namesPage of them from start, with where the next page starts or None
+			if request.get('version') == self._version:
+				self._reply(socket, request, version = self._version)
+			else:
+				start = request.get('start', 0)
+				names = [name for (owner, name) in itertools.islice(self._owners.values(), start, start + self.namesPage)]
+				end = start + len(names)
+				self._reply(socket, request, version = self._version, names = names,
+					next = end if end < len(self._owners) else None)
+
+		elif op == 'pm':
+			# Hand a private message to whichever worker holds the receiver
+			owner = self._owners.get(request['to'].casefold())
+			# or keep it until someone claims that name. stored is None without a mailbox, False when it is full
+			stored = None
+			if owner is not None:
+				deliver = dict(request, op = 'deliver')
+				del deliver['id']
+				owner[0].send(json.dumps(deliver, ensure_ascii = False).encode())
+			elif self.mailbox is not None:
+				stored = self.mailbox.post(request['to'], request['sender'], request['body'])
+			self._reply(socket, request, ok = owner is not None, stored = stored)
+
+		elif op == 'broadcast':
+			# Pass the line on untouched to every other worker that was admitted
+			self.broadcast((worker for worker in self._workers if worker.admitted), message, exclude = socket)
+
+		elif op == 'join':
+			key = request['room'].casefold()
+			self._rooms.setdefault(key, [request['room'], 0])[1] += 1
+			socket.rooms[key] += 1
+
+		elif op == 'part':
+			self._part(socket, request['room'].casefold(), 1)
+
+		elif op == 'rooms':
+			# The biggest rooms, and how many there are in all
+			rooms = heapq.nlargest(self.roomsLimit, self._rooms.values(), key = lambda room: room[1])
+			self._reply(socket, request, rooms = rooms, total = len(self._rooms))
+
+		return True
+
+	def _part(self, socket, key, count):
+		if socket.rooms[key] < count:
+			return
+		socket.rooms[key] -= count
+		if not socket.rooms[key]:
+			del socket.rooms[key]
+		room = self._rooms[key]
+		room[1] -= count
+		if not room[1]:
+			del self._rooms[key]
+
+	def _release(self, socket, name):
+		if name is not None and name.casefold() in socket.names:
+			del self._owners[name.casefold()]
+			socket.names.discard(name.casefold())
+			self._version += 1
+
+	def _reply(self, socket, request, **fields):
+		fields['reply'] = request['id']
+		socket.send(json.dumps(fields, ensure_ascii = False).encode())
+
+
+class BusClient(Client):
+	"""
+	A worker process' connection to its BusHub.
+
+	Messages relayed from other workers arrive through onBusMessage, on the
+	bus thread. When the hub goes away requests fail with ConnectionError
+	until the client is back, then onBusReconnect is called.
+	"""
+
+	# Seconds between attempts to get back to a hub that went away
+	retryInterval = 1
+	# As long as the hub's, see BusHub
+	maxLineLength = BusHub.maxLineLength
+	highWaterMark = BusHub.highWaterMark
+
+	def __init__(self):
+		super(BusClient, self).__init__()
+		self._ids = itertools.count()
+		# key = request id, value = [event, reply]
+		self._pending = {}
+		self.connected = False
+
+	def start(self, address, timeout=10, secret=None):
+		"""
+		Connect to the hub at address, a Unix socket path or a (host, port)
+		pair, waiting for it to come up. secret is the hub's, if it has one.
+		"""
+		(self._address, self._secret) = (address, secret)
+		(ip, port) = (address, None) if isinstance(address, str) else address
+		deadline = time.time() + timeout
+		while True:
+			try:
+				Client.start(self, ip, port)
+				break
+			except (FileNotFoundError, ConnectionRefusedError):
+				if time.time() > deadline:
+					raise
+				time.sleep(0.05)
+		if secret is not None:
+			self.publish('hello', secret = secret)
+		self.connected = True
+
+	def publish(self, op, **fields):
+		"""Send a message to the hub without waiting for an answer."""
+		fields['op'] = op
+		self._wrappedSocket.send(json.dumps(fields, ensure_ascii = False).encode())
+
+	def request(self, op, timeout=5, **fields):
+		"""
+		Send a message to the hub and block until it answers. Raises
+		TimeoutError when it does not, ConnectionError while it is away.
+		"""
+		if not self.connected:
+			raise ConnectionError(f"the bus is down, can not {op}")
+		fields['id'] = next(self._ids)
+		pending = [threading.Event(), None]
+		self._pending[fields['id']] = pending
+		try:
+			self.publish(op, **fields)
+			if not pending[0].wait(timeout):
+				raise TimeoutError(f"no answer from the bus for {op}")
+		finally:
+			del self._pending[fields['id']]
+		# Woken without an answer, the hub went away meanwhile
+		if pending[1] is None:
+			raise ConnectionError(f"the bus went down during {op}")
+		return pending[1]
+
+	def names(self, version=None):
+		"""
+		(version, names) of every username claimed on the hub, names is None
+		if they are the same as at version. Fetched a page at a time, and
+		again from the start if they change in between.
+		"""
+		while True:
+			reply = self.request('names', version = version)
+			if 'names' not in reply:
+				return (reply['version'], None)
+			(current, names) = (reply['version'], reply['names'])
+			while reply['next'] is not None and reply['version'] == current:
+				reply = self.request('names', start = reply['next'])
+				names += reply['names']
+			if reply['version'] == current:
+				return (current, names)
+			version = None
+
+	def onMessage(self, socket, message):
+		message = json.loads(message)
+		pending = self._pending.get(message.get('reply'))
+		if pending is not None:
+			pending[1] = message
+			pending[0].set()
+		elif 'reply' not in message:
+			self.onBusMessage(message)
+		return True
+
+	def onJoin(self):
+		# Stopped on purpose
+		if not self.isRunning():
+			return Client.onJoin(self)
+		# The hub went away, fail whoever waits on it and keep trying to get back to it
+		self.connected = False
+		for pending in list(self._pending.values()):
+			pending[0].set()
+		threading.Thread(target = self._reconnect, daemon = True).start()
+
+	def _reconnect(self):
+		while self.isRunning():
+			try:
+				self.start(self._address, timeout = 0, secret = self._secret)
+			except OSError:
+				time.sleep(self.retryInterval)
+				continue
+			self.onBusReconnect()
+			return
+
+	def onBusMessage(self, message):
+		pass
+
+	def onBusReconnect(self):
+		"""Back on the hub after it went away, it knows nothing of this worker now."""
+		pass
+
+
+class AsyncSocket():
+	"""
+	Mutable wrapper class for asyncio stream connections.
+	"""
+
+	def __init__(self, reader, writer):
+		# Store internal stream pointers
+		self._reader = reader
+		self._writer = writer
+
+	def send(self, msg):
+		# Ensure a single new-line after the message
+		self.sendFrame(msg.strip()+b"\n")
+
+	def sendMessage(self, kind, body, sender='', target='', frames=None):
+		# Asyncio connections always speak the text protocol
+		data = frames.get(TEXT_CODEC) if frames is not None else None
+		if data is None:
+			data = TEXT_CODEC.message(kind, body, sender, target)
+			if frames is not None:
+				frames[TEXT_CODEC] = data
+		self.sendFrame(data)
+
+	def sendMessages(self, messages):
+		"""Send many (kind, body, sender, target) messages in a single write."""
+		self.sendFrame(b"".join(TEXT_CODEC.message(*message) for message in messages))
+
+	@property
+	def queuedBytes(self):
+		"""Bytes the transport has not written yet."""
+		return self._writer.transport.get_write_buffer_size()
+
+	def sendFrame(self, data):
+		# Buffered by the transport
+		if not self._writer.is_closing():
+			self._writer.write(data)
+
+	def peerName(self):
+		"""The address of the peer, a path for Unix domain sockets."""
+		return self._writer.get_extra_info('peername')
+
+	def close(self):
+		self._writer.close()
+
+
+async def _maybeAwait(result):
+	"""Await the result of a hook if it was declared with async def."""
+	if inspect.isawaitable(result):
+		result = await result
+	return result
+
+
+class AsyncReceiver(Receiver):
+	"""
+	A Receiver driven by asyncio streams instead of blocking sockets.
+
+	Hooks may be plain methods or coroutines.
+	"""
+
+	# Seconds a connection may stay silent before it is pinged, None to never check
+	idleTimeout = None
+	# Seconds a pinged connection has to send anything back before it is dropped
+	heartbeatTimeout = 10
+
+	async def _serve(self, socket):
+		"""Run one connection until it closes or the receiver stops."""
+		self._track(socket)
+		await _maybeAwait(self.onConnect(socket))
+		try:
+			while self.isRunning():
+				try:
+					line = await self._readline(socket)
+				except (ConnectionError, ValueError, asyncio.TimeoutError):
+					# Connection reset, a line over the stream limit or a heartbeat left unanswered
+					break
+				# A line without its new-line only happens at end of stream
+				if not line.endswith(b'\n'):
+					break
+				socket.lastReceived = time.monotonic()
+				if self.metrics is not None:
+					self.metrics.bytesIn.inc(len(line))
+
+				message = line[:-1].decode(errors = 'replace')
+				# Over the rate limit, dropped before it is dispatched, pings included
+				if not self._admit(socket, message):
+					if not self._throttled(socket, message):
+						break
+					continue
+				if message.startswith(_CONTROL):
+					self._control(socket, PING if message[2] == 'i' else PONG, message[6:])
+					continue
+
+				success = await _maybeAwait(self.onMessage(socket, message))
+				if not success:
+					break
+
+				# Let the transport push back on a fast sender
+				try:
+					await socket._writer.drain()
+				except ConnectionError:
+					break
+		finally:
+			await _maybeAwait(self.onDisconnect(socket))
+			socket.close()
+			self._untrack(socket)
+
+	async def _readline(self, socket):
+		"""The next line, pinging the peer first if it stays quiet for idleTimeout."""
+		if self.idleTimeout is None:
+			return await socket._reader.readline()
+		# A cancelled readline leaves what it had read in the stream
+		try:
+			return await asyncio.wait_for(socket._reader.readline(), self.idleTimeout)
+		except asyncio.TimeoutError:
+			pass
+		# Anything the peer sends, a pong included, counts as an answer
+		socket._heartbeat = time.monotonic()
+		socket.sendMessage(PING, 'heartbeat')
+		if self.metrics is not None:
+			self.metrics.heartbeats.inc()
+		try:
+			return await asyncio.wait_for(socket._reader.readline(), self.heartbeatTimeout)
+		except asyncio.TimeoutError:
+			if self.metrics is not None:
+				self.metrics.evictions.inc()
+			raise
+
+
+class AsyncServer(AsyncReceiver):
+
+	def start(self, ip, port):
+		"""Serve on (ip, port) until stopped, blocking like Server.start."""
+		asyncio.run(self.serve(ip, port))
+
+	async def serve(self, ip, port):
+		"""Coroutine version of start() for use inside a running loop."""
+		self._loop = asyncio.get_running_loop()
+		self._stopped = asyncio.Event()
+		self._sockets = set()
+		if not self.isRunning():
+			self._stopped.set()
+
+		server = await asyncio.start_server(self._handle, ip, int(port), limit = self.maxLineLength + 1)
+
+		# On start!
+		await _maybeAwait(self.onStart())
+
+		await self._stopped.wait()
+
+		# Stop accepting, then close every connection so its handler finishes
+		server.close()
+		tasks = [task for (socket, task) in self._sockets]
+		for (socket, task) in list(self._sockets):
+			socket.close()
+		await asyncio.gather(*tasks, return_exceptions=True)
+		await server.wait_closed()
+
+		# On stop!
+		await _maybeAwait(self.onStop())
+
+	async def _handle(self, reader, writer):
+		if self.metrics is not None:
+			self.metrics.accepts.inc()
+		socket = AsyncSocket(reader, writer)
+		entry = (socket, asyncio.current_task())
+		self._sockets.add(entry)
+		try:
+			await self._serve(socket)
+		finally:
+			self._sockets.discard(entry)
+
+	def stop(self):
+		"""Stop this server. Safe to call from any thread."""
+		Receiver.stop(self)
+		loop = getattr(self, '_loop', None)
+		if loop is not None and not loop.is_closed():
+			loop.call_soon_threadsafe(self._stopped.set)
+
+	def onStart(self):
+		pass
+
+	def onStop(self):
+		pass
+
+
+class AsyncClient(AsyncReceiver):
+
+	def start(self, ip, port):
+		"""Connect and run the client on a background loop, like Client.start."""
+		self._loop = asyncio.new_event_loop()
+		self._thread = threading.Thread(target = self._loop.run_forever)
+		self._thread.start()
+		try:
+			asyncio.run_coroutine_threadsafe(self.connect(ip, port), self._loop).result()
+		except BaseException:
+			self._loop.call_soon_threadsafe(self._loop.stop)
+			self._thread.join()
+			self._loop.close()
+			raise
+		self._task = asyncio.run_coroutine_threadsafe(self.run(), self._loop)
+
+	async def connect(self, ip, port):
+		"""Open the connection; await run() afterwards to receive messages."""
+		(reader, writer) = await asyncio.open_connection(ip, int(port), limit = self.maxLineLength + 1)
+		self._socket = AsyncSocket(reader, writer)
+
+		# On start!
+		await _maybeAwait(self.onStart())
+
+	async def run(self):
+		"""Receive messages until the connection closes."""
+		await self._serve(self._socket)
+
+		# On join!
+		await _maybeAwait(self.onJoin())
+
+	def send(self, message):
+		"""Send message to the server. Safe to call from any thread."""
+		loop = getattr(self, '_loop', None)
+		if loop is None or threading.current_thread() is self._thread:
+			self._socket.send(message)
+		else:
+			loop.call_soon_threadsafe(self._socket.send, message)
+
+	async def _shutdown(self):
+		self._socket.close()
+
+		# On stop!
+		await _maybeAwait(self.onStop())
+
+	def stop(self):
+		"""Stop this client. Safe to call from any thread."""
+		if not self.isRunning():
+			return
+		Receiver.stop(self)
+
+		thread = getattr(self, '_thread', None)
+		if thread is None:
+			# Running inside a loop owned by the caller
+			asyncio.ensure_future(self._shutdown())
+		elif threading.current_thread() is thread:
+			# Called from the loop itself, e.g. onJoin once the server hung up
+			task = self._loop.create_task(self._shutdown())
+			task.add_done_callback(lambda task: self._loop.stop())
+		else:
+			asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+			try:
+				self._task.result()
+			except Exception:
+				pass
+			self._loop.call_soon_threadsafe(self._loop.stop)
+			thread.join()
+			self._loop.close()
+
+	def onStart(self):
+		pass
+
+	def onStop(self):
+		pass
+
+	def onJoin(self):
+		self.stop()
@@ -10,8 +10,10 @@ To run this script, follow these steps:
 4. Open a terminal or command prompt.
 5. Navigate to the directory containing "myclient.py" and "ex2utils.py".
 6. Run the following command to start the client:
-   python3 myclient.py <server_ip> <server_port>
+   python3 myclient.py <server_ip> <server_port> [text|binary] [deflate]
    Replace <server_ip> with the IP address of the server you want to connect to, and <server_port> with the port number the server is listening on.
+   With binary the client asks for length prefixed frames and renders the colours itself.
+   With deflate the connection is compressed both ways, which pays off on slow links.
 7. Once the client is connected to the server, you can start sending messages. Type your message and press Enter to send it to the server.
 8. To gracefully disconnect from the server and exit the client, use /close command.
 
@@ -48,6 +50,10 @@ class IRCClient(Client):
 try:
     ip = sys.argv[1]
     port = int(sys.argv[2])
+    protocol = sys.argv[3] if len(sys.argv) > 3 else 'text'
+    compress = 'deflate' in sys.argv[3:]
+    if protocol == 'deflate':
+        protocol = 'text'
 # when the user's input arguments are not in the right formant.
 except IndexError:
     print("\033[1;31;43m" + "List index out of range. Proper usage: python3 myclient.py localhost 8090" + "\033[0m")
@@ -58,7 +64,7 @@ client = IRCClient()
 
 # Start server
 try:
-    client.start(ip, port)
+    client.start(ip, port, protocol, compress)
 # when the server has not yet running.
 except ConnectionRefusedError:
     print(f"{client.burgundy}Server has not yet established, failed to connect.{client.base}")
@@ -37,84 +37,414 @@ implementing some or all of the following five events.
 
 """
 
+import argparse
+import bisect
+import ipaddress
+import logging
+import os
+import shutil
+import signal
 import sys
-from ex2utils import Server
+import tempfile
+import threading
+import time
+from ex2utils import Server, BusHub, BusClient, PresenceRegistry, RoomRegistry, History, MessageLog, Metrics, TokenBucket, Capture
+from ex2utils import Mailbox
+from ex2utils import Command, command, render, startLogging
+from ex2utils import NOTICE, ERROR, PUBLIC, ECHO, PRIVATE_FROM, PRIVATE_TO, USER_LIST, ROOM_PUBLIC, ROOM_ECHO
+
+# log records are written by a background thread once startLogging() has run, and
+# per command details are only formatted at the DEBUG level.
+log = logging.getLogger('myserver')
 
 # Create an echo server class
 class MyServer(Server):
-    def __init__(self):
+    # (rate, burst) of messages a user may send under one username, whatever connection they use,
+    # and of chat room and room messages this server broadcasts in all. None for no limit.
+    # the per connection limit is Server.rateLimit, enforced before onMessage is called.
+    userRateLimit = None
+    broadcastRateLimit = None
+    # usernames per /userlist page.
+    userlistPageSize = 50
+    # longest username and room name in characters, they travel in every message's binary frame.
+    maxNameLength = 32
+    # seconds the joins and leaves are gathered for before a presence update goes to the subscribers.
+    presenceInterval = 1
+
+    def __init__(self, bus=None, metrics=None, history=None, mailbox=None):
         super(MyServer, self).__init__()
+        # ex2utils.Metrics recording traffic, dispatch latency and commands, or None to run without.
+        # /stats shows them to clients on this machine.
+        if metrics is not None:
+            self.instrument(metrics)
+            self.commandCount = metrics.counter('commands_total', "Commands handled, by command.", 'command')
+            metrics.gauge('users', "Users connected to this server.", lambda: self.userCount)
+            metrics.gauge('chatroom_users', "Users with a username on this server.", lambda: len(self.registry.members()))
+            metrics.gauge('queued_bytes', "Bytes waiting for slow clients.",
+                          lambda: sum(client_socket.queuedBytes for client_socket, username in self.registry.everyone()))
+            metrics.gauge('max_queued_bytes', "Bytes waiting for the slowest client.",
+                          lambda: max((client_socket.queuedBytes for client_socket, username in self.registry.everyone()), default=0))
+            metrics.gauge('rooms', "Rooms with members on this server.", lambda: len(self.rooms))
+        # BusClient linking this worker process to the others, and through a hub on TCP to the workers
+        # of linked servers on other hosts, None when running alone. usernames, chat room and room
+        # messages, /pm, /userlist and /rooms then span every worker.
+        self.bus = bus
+        if bus is not None:
+            bus.onBusMessage = self.onBusMessage
+            bus.onBusReconnect = self.onBusReconnect
+
+        # guards the counters below. Callbacks run concurrently, so every change to them
+        # happens under this lock and no send is made while holding it.
+        self._stateLock = threading.Lock()
+
         # class attribute for counting total connected users.
         self.userCount = 0
 
         # class attribute for counting total users connected to the chatroom.
         self.userNoInChatRoom = 0
 
-        # contains server connected user's socket object as a key.
-        # key = socket object, value = socket.name which is Non initially if connected successfully.
-        # when username registration, the value will be set to their username which is socket.name.
-        self.connected_user = {}
-
-        # key = username , value = socket object of that user.
-        self.userNameKeyObjectValueDict = {}
+        # every server connected user's socket and the username it has claimed, which is None
+        # until /username. indexed both ways and case-insensitively, so registering, renaming,
+        # looking up and removing a user is O(1). it hands out read-only snapshots for broadcasts.
+        self.registry = PresenceRegistry()
+
+        # the rooms opened with /join and their members, so a room message only touches that room.
+        # a user's plain messages go to the room they joined last, kept in socket.room, or to
+        # everyone in the chat room when socket.room is None.
+        self.rooms = RoomRegistry()
+
+        # ex2utils.History of the chat room messages, replayed to a user once they set their username,
+        # or None to keep no history. each room gets its own of the same capacity, kept in memory
+        # while the room has members here and replayed on /join. key = casefolded room name.
+        self.history = history
+        self.roomHistory = {}
+
+        # ex2utils.Mailbox keeping the /pm for users who are not connected until they set that username,
+        # or None to turn those away. with worker processes the bus hub keeps them instead, for every worker.
+        self.mailbox = mailbox
+
+        # token buckets of the rate limits, guarded by _bucketLock. key = casefolded username.
+        # a refilled bucket is no different from a new one, so those are dropped once there are many.
+        self._bucketLock = threading.Lock()
+        self.userBuckets = {}
+        self._pruneAt = 1024
+        self.broadcastBucket = None
+
+        # the usernames as (version, sorted usernames, casefolded usernames), and (version, pages) of the
+        # /userlist pages already encoded from that version. key = (casefolded prefix, page),
+        # value = (kind, body, frames). with worker processes the usernames come from the bus, only
+        # when they changed there.
+        self._usernames = (None, (), ())
+        self._userlistPages = (None, {})
+
+        # sockets that turned presence updates on with /presence. they get the joins and leaves
+        # gathered over presenceInterval in one notice, instead of a notice for each.
+        # key = casefolded username, value = [username, joins minus leaves].
+        self.presenceSubscribers = set()
+        self._presenceDeltas = {}
+        self._presenceTimer = None
+
+        # messages are sent as a kind (NOTICE, ERROR, PUBLIC...) plus fields. colours are
+        # added by ex2utils.render() for text clients, binary clients render them on their side.
+
+    def _sendPrivate(self, username, sender, body):
+        # deliver a private message to a user on this worker or, through the bus, on another worker.
+        # 'sent', 'stored' in the mailbox when nobody has the username, 'full' when that user's mailbox is,
+        # or 'unknown' without a mailbox.
+        receiverSocket = self.registry.lookup(username)
+        if receiverSocket is not None:
+            receiverSocket.sendMessage(PRIVATE_FROM, body, sender)
+            return 'sent'
+        if self.bus is not None:
+            reply = self.bus.request('pm', to=username, sender=sender, body=body)
+            if reply['ok']:
+                return 'sent'
+            stored = reply.get('stored')
+        else:
+            stored = self.mailbox.post(username, sender, body) if self.mailbox is not None else None
+            # the receiver may have claimed the username while it was posted, then they get it now.
+            receiverSocket = self.registry.lookup(username) if stored else None
+            if receiverSocket is not None:
+                self._deliverMail(receiverSocket, self.mailbox.take(username))
+        if stored is None:
+            return 'unknown'
+        return 'stored' if stored else 'full'
+
+    def _takeMail(self, claim, username):
+        # the private messages kept for a username just claimed, from the bus hub's mailbox
+        # in the answer to the claim, or from our own.
+        if claim is not None:
+            return claim.get('mail', [])
+        return self.mailbox.take(username) if self.mailbox is not None else []
+
+    def _deliverMail(self, socket, mail):
+        # hand a user the private messages kept while nobody had their username, all in one write.
+        if mail:
+            messages = [(NOTICE, f"{len(mail)} private message{'s' if len(mail) > 1 else ''} came while you were away")]
+            messages += [(PRIVATE_FROM, f"[{time.strftime('%Y-%m-%d %H:%M', time.localtime(sent))}] {body}", sender, '')
+                         for (sender, body, sent) in mail]
+            socket.sendMessages(messages)
+
+    def _publish(self, kind, body, sender='', room=None, audience=None):
+        # send a chat room message, or a message to a room, to the users on the other workers.
+        # the audience of a join or leave notice is 'notices', of a presence update 'presence'.
+        if self.bus is not None:
+            self.bus.publish('broadcast', kind=kind, body=body, sender=sender, room=room, audience=audience)
+
+    def _record(self, kind, body, sender, room=None):
+        # keep a chat room or room message for the users who come later. returns the encoding cache
+        # to broadcast it with, so the same frames go out live and in the replays.
+        if self.history is None:
+            return None
+        if room is None:
+            return self.history.append(kind, body, sender)
+        with self._stateLock:
+            history = self.roomHistory.get(room.casefold())
+            if history is None:
+                history = self.roomHistory[room.casefold()] = History(self.history.capacity)
+        return history.append(kind, body, sender, room)
+
+    def _forget(self, room):
+        # drop a room's history once its last member here has left.
+        if not self.rooms.members(room):
+            with self._stateLock:
+                self.roomHistory.pop(room.casefold(), None)
+
+    def onBusMessage(self, message):
+        # a chat room or room message from another worker.
+        if message['op'] == 'broadcast':
+            room = message.get('room')
+            recipients = self.registry.members() if room is None else self.rooms.members(room)
+            if message.get('audience') == 'notices':
+                recipients = self._unsubscribed(recipients)
+            elif message.get('audience') == 'presence':
+                recipients = tuple(self.presenceSubscribers)
+            # chat messages are recorded by every worker, so each one has the whole history.
+            frames = None
+            if message['kind'] in (PUBLIC, ROOM_PUBLIC) and (room is None or recipients):
+                frames = self._record(message['kind'], message['body'], message['sender'], room)
+            self.broadcastMessage(recipients, message['kind'], message['body'], message['sender'], room or '', frames=frames)
+        # a private message for one of our users routed by the hub.
+        elif message['op'] == 'deliver':
+            receiverSocket = self.registry.lookup(message['to'])
+            if receiverSocket is not None:
+                receiverSocket.sendMessage(PRIVATE_FROM, message['body'], message['sender'])
+
+    def onBusReconnect(self):
+        # the hub forgot this worker's usernames and rooms when it went away, claim and join them again.
+        self._usernames = (None, (), ())
+        for (client_socket, username) in self.registry.everyone():
+            if username is None:
+                continue
+            try:
+                claim = self.bus.request('claim', name=username, old=None)
+            except (TimeoutError, ConnectionError):
+                return
+            # someone on another server took the name while we were cut off.
+            if not claim['ok']:
+                client_socket.sendMessage(ERROR, f"{username} was taken on another server, please set a new username")
+            else:
+                self._deliverMail(client_socket, claim.get('mail', []))
+            for room in self.rooms.roomsOf(client_socket):
+                self.bus.publish('join', room=room)
+
+    def _count(self, command):
+        # count a handled command for the metrics, unregistered ones all as 'unknown'.
+        if self.metrics is not None:
+            self.commandCount.inc(value=command if command in self.handlers or command == 'message' else 'unknown')
+
+    def _isLocal(self, socket):
+        # whether the client is on this machine, through loopback or a unix socket.
+        peer = socket.peerName()
+        return not isinstance(peer, tuple) or ipaddress.ip_address(peer[0]).is_loopback
+
+    def _takeUser(self, username):
+        # whether the user is within the per username rate limit.
+        key = username.casefold()
+        with self._bucketLock:
+            bucket = self.userBuckets.get(key)
+            if bucket is None:
+                if len(self.userBuckets) >= self._pruneAt:
+                    now = time.monotonic()
+                    for name in [name for name, userBucket in self.userBuckets.items() if userBucket.full(now)]:
+                        del self.userBuckets[name]
+                    self._pruneAt = max(1024, 2 * len(self.userBuckets))
+                bucket = self.userBuckets[key] = TokenBucket(*self.userRateLimit)
+            return bucket.take()
+
+    def _takeBroadcast(self):
+        # whether one more chat room or room message fits the global broadcast rate limit.
+        if self.broadcastBucket is None:
+            return True
+        with self._bucketLock:
+            return self.broadcastBucket.take()
+
+    def _throttle(self, socket, limit, warning):
+        # drop a message over a rate limit, warning the user once until a message of theirs gets through.
+        if self.metrics is not None and limit != 'connection':
+            self.metrics.throttled.inc(value=limit)
+        if not socket.throttled:
+            socket.throttled = True
+            socket.sendMessage(ERROR, warning)
+        return True
 
-        # colour attributes.
-        self.green = "\033[1;32m"
-        self.yellow = "\033[1;33m"
-        self.burgundy = "\033[1;31;43m"
-        self.violet = "\033[1;35m"
-        self.cyan = "\033[1;36m"
-        self.margenta = "\033[1;94m"
-        self.base = "\033[0m"
+    def onThrottled(self, socket, message):
+        # over the per connection rate limit, already counted by the receiver.
+        return self._throttle(socket, 'connection', "You are sending messages too fast, some of them were dropped")
+
+    def _unsubscribed(self, sockets):
+        # the sockets that get a notice for every join and leave, the ones without presence updates.
+        subscribers = self.presenceSubscribers
+        if not subscribers:
+            return sockets
+        return [client_socket for client_socket in sockets if client_socket not in subscribers]
+
+    def _presence(self, username, change):
+        # note a username joining (1) or leaving (-1) for the next presence update. a join and
+        # a leave within the same interval cancel out.
+        if not self.presenceSubscribers and self.bus is None:
+            return
+        key = username.casefold()
+        with self._stateLock:
+            delta = self._presenceDeltas.get(key)
+            if delta is None:
+                self._presenceDeltas[key] = [username, change]
+            else:
+                delta[0] = username
+                delta[1] += change
+                if not delta[1]:
+                    del self._presenceDeltas[key]
+            # one timer per interval, and none while nothing happens.
+            if self._presenceTimer is None:
+                self._presenceTimer = threading.Timer(self.presenceInterval, self._sendPresence)
+                self._presenceTimer.daemon = True
+                self._presenceTimer.start()
+
+    def _sendPresence(self):
+        # the presence update: who joined and who left since the last one, in a single notice.
+        with self._stateLock:
+            deltas = self._presenceDeltas
+            self._presenceDeltas = {}
+            self._presenceTimer = None
+            subscribers = tuple(self.presenceSubscribers)
+        joined = [username for username, change in deltas.values() if change > 0]
+        left = [username for username, change in deltas.values() if change < 0]
+        lines = []
+        if joined:
+            lines.append("Joined: " + ", ".join(joined))
+        if left:
+            lines.append("Left: " + ", ".join(left))
+        if lines:
+            self.broadcastMessage(subscribers, NOTICE, '\n'.join(lines))
+            self._publish(NOTICE, '\n'.join(lines), audience='presence')
+
+    def _names(self):
+        # the usernames, sorted case-insensitively, rebuilt only when they changed.
+        usernames = self._usernames
+        if self.bus is None:
+            (version, names) = self.registry.snapshot()
+            if version == usernames[0]:
+                return usernames
+        else:
+            (version, names) = self.bus.names(usernames[0])
+            if names is None:
+                return usernames
+            names = tuple(sorted(names, key=str.casefold))
+        usernames = self._usernames = (version, names, tuple(name.casefold() for name in names))
+        return usernames
+
+    def _userlistPage(self, names, keys, prefix, page):
+        # one /userlist page of the usernames starting with prefix, found by bisecting the sorted names.
+        first = bisect.bisect_left(keys, prefix.casefold())
+        last = bisect.bisect_left(keys, prefix.casefold() + '\U0010ffff') if prefix else len(keys)
+        if prefix and first == last:
+            return (ERROR, f"No username starts with {prefix}", {})
+        pages = max(1, -(-(last - first) // self.userlistPageSize))
+        if page > pages:
+            return (ERROR, f"There is no page {page}, the list has {pages}", {})
+        start = first + (page - 1) * self.userlistPageSize
+        lines = list(names[start:min(last, start + self.userlistPageSize)])
+        if page < pages:
+            lines.append(f"Page {page} of {pages}, /userlist {prefix + ' ' if prefix else ''}{page + 1} for more")
+        elif pages > 1:
+            lines.append(f"Page {page} of {pages}")
+        return (USER_LIST, '\n'.join(lines), {})
 
     def onStart(self):
-        print("Server has started")
+        if self.broadcastRateLimit is not None:
+            self.broadcastBucket = TokenBucket(*self.broadcastRateLimit)
+        log.info("Server has started")
         
     def onStop(self):
-        print("Server has ended")		
+        log.info("Server has ended")		
         
     def onConnect(self, socket):
         # initially set the username as None to mark this user has never set the username before.
         socket.name = None
-        # put the socket name to socket object key to keep track of connected user's sockets.
-        self.connected_user[socket] = socket.name
-        # increment user count by 1.
-        self.userCount += 1
+        # not in any room yet, messages go to the whole chat room.
+        socket.room = None
+        # whether the user was told about going over a rate limit since a message of theirs last got through.
+        socket.throttled = False
+        # keep track of connected user's sockets.
+        self.registry.connect(socket)
+        with self._stateLock:
+            # increment user count by 1.
+            self.userCount += 1
+            userCount = self.userCount
+        recipients = self.registry.everyone()
+        message = f"New user has been connected to the server, Current users in the server: {userCount}"
         # server side message displaying.
-        print(f"{self.yellow}New user has been connected to the server, Current users in the server: {self.userCount}{self.base}")
+        log.info(render(NOTICE, message))
         # client side message displaying.
-        # display new user connection notice to all the current online clients.
-        for client_socket in self.connected_user.keys():
-            message = f"{self.yellow}New user has been connected to the server, Current users in the server: {self.userCount}{self.base}"
-            client_socket.send(message.encode())
-        notice = f"{self.yellow}/help to refer commands.{self.base}"
-        socket.send(notice.encode())
+        # display new user connection notice to all the current online clients, encoded once for all of them.
+        # users with presence updates on only hear about users that set a username.
+        self.broadcastMessage(self._unsubscribed(client_socket for client_socket, username in recipients), NOTICE, message)
+        socket.sendMessage(NOTICE, "/help to refer commands.")
 
     def onDisconnect(self, socket):
-        # decrement user count by 1.
-        self.userCount -= 1
+        # delete disconnected user's socket and release its username.
+        self.registry.disconnect(socket)
+        with self._stateLock:
+            self.presenceSubscribers.discard(socket)
+        # leave every room the user was in, only touching those rooms.
+        for room in self.rooms.leaveAll(socket):
+            self._forget(room)
+            if self.bus is not None:
+                self.bus.publish('part', room=room)
+        with self._stateLock:
+            # decrement user count by 1.
+            self.userCount -= 1
+            userCount = self.userCount
+        # when the server is stopping everyone is leaving and has been told so by onShutdown already.
+        if not self.isRunning():
+            socket.name = None
+            return
+        recipients = self.registry.everyone()
         # server side message displaying.
-        print(f"{self.yellow}User has been disconnected from the server, Current users: {self.userCount}{self.base}")
-        # delete disconnected user's socket.
-        del self.connected_user[socket]
-        if socket.name is not None:
-            del self.userNameKeyObjectValueDict[socket.name]
+        log.info(render(NOTICE, f"User has been disconnected from the server, Current users: {userCount}"))
         # client side message displaying.
         # display new user disconnection notice to all the current online clients.
-        for client_socket, username in self.connected_user.items():
-            # if the user's username has not yet setted, inform them wihtout sepecific username.
-            if username is None:
-                message =f"{self.yellow}User has been disconnected from the chatroom and the server, Current users: {self.userCount}{self.base}"
-                client_socket.send(message.encode())
-            # if the user's in the chatroom with username
-            else:
-                # if the disconnected user's username has not set yet, inform it as "User".
-                if socket.name == None:
-                    socket.name = "User"
-                message =f"{self.yellow}{socket.name} has been disconnected from the chatroom and the server, Current users: {self.userCount}{self.base}"
-                client_socket.send(message.encode())
+        # if the user's username has not yet setted, inform them wihtout sepecific username.
+        message = f"User has been disconnected from the chatroom and the server, Current users: {userCount}"
+        self.broadcastMessage(self._unsubscribed(client_socket for client_socket, username in recipients if username is None),
+                              NOTICE, message)
+        # if the user's in the chatroom with username, name who left, or "User" if the disconnected user's username has not set yet.
+        leaver = socket.name if socket.name is not None else "User"
+        message = f"{leaver} has been disconnected from the chatroom and the server, Current users: {userCount}"
+        self.broadcastMessage(self._unsubscribed(client_socket for client_socket, username in recipients if username is not None),
+                              NOTICE, message)
+        if socket.name is not None:
+            self._presence(socket.name, -1)
+        # free the username on the other workers and tell their chat room.
+        if self.bus is not None and socket.name is not None:
+            self.bus.publish('release', name=socket.name)
+            self._publish(NOTICE, message, audience='notices')
         socket.name = None
         
+    def onShutdown(self, socket):
+        # the server is stopping, this is the last thing the user gets before the connection closes.
+        socket.sendMessage(NOTICE, "The server is shutting down, goodbye")
+
     def onMessage(self, socket, message):
         # This function takes two arguments: 'socket' and 'message'.
         #     'socket' can be used to send a message string back over the wire.
@@ -127,162 +457,525 @@ class MyServer(Server):
         # message=message.encode()
         # socket.send(message)
 
+        # a registered user's messages and commands all count towards their per username rate limit.
+        if socket.name is not None and self.userRateLimit is not None and not self._takeUser(socket.name):
+            return self._throttle(socket, 'user', "You are sending messages too fast, some of them were dropped")
+
         # if the message startswith /, command can be used.
         if message.startswith('/'):
-            # if user only type '/', alert that user to use valid command and parameters.
-            if len(message.strip()) == 1 and message[0] == '/':
-                alert = f"{self.burgundy}Please type a valid command and parameters.\n" \
-                f"Use /help to refer usage of command and parameters.{self.base}"
-                socket.send(alert.encode())
-            # remove '/' 
-            message = message[1:]
-            # split the message to seperate command and parameters.
-            # type of the message variable is now list.
-            message = message.strip().split()
-
-            if len(message) > 0:
-                command = message[0]
-                parameters = ", ".join(message[1:])
-                print(f"Command is :: {command}")
-                print(f"Parameters are :: {parameters}")
-
-                if command.strip().lower() == 'username':
-                    username = parameters
-                    # when the user tries to set their username as ' '.
-                    if username != "" and ' ' not in username:
-                        # if ther username has not yet taken and the user has not been regiesterd username before at all.
-                        if username not in self.connected_user.values() and socket.name == None:
-                                # increment the numser of user in the chatroom by 1.
-                                self.userNoInChatRoom += 1
-                                # set the username into socket.name.
-                                socket.name = username
-                                # set the socket's value from None to their username.
-                                self.connected_user[socket] = username
-                                # set the username as key and socket object as value.
-                                self.userNameKeyObjectValueDict[username] = socket
-                                # notice the user that the username has set.
-                                alert = f"{self.yellow}Username has set to {username}{self.base}"
-                                socket.send(alert.encode())
-                                # notice all the chatroom connected user that the new user has connected to the chatroom.
-                                for client_socket in self.userNameKeyObjectValueDict.values():
-                                    message = f"{self.yellow}{socket.name} has been connected to the chatroom, Current user in the chat room: {self.userNoInChatRoom}{self.base}"
-                                    client_socket.send(message.encode())
-                        else:
-                            # when the username is already set to the user.
-                            if self.connected_user[socket] == username:
-                                alert = f"{self.burgundy}Username already set to {username}{self.base}"
-                                socket.send(alert.encode())
-                            # if that username is taken by other user.
-                            elif self.connected_user[socket] != username and username in self.connected_user.values():
-                                alert = f"{self.burgundy}Username has already taken{self.base}"
-                                socket.send(alert.encode())
-                            # user with the username wants to change the username.
-                            else:
-                                del self.userNameKeyObjectValueDict[socket.name]
-                                socket.name = username
-                                self.connected_user[socket] = username
-                                self.userNameKeyObjectValueDict[username] = socket
-                                alert = f"{self.yellow}Username has changed to {username}{self.base}"
-                                socket.send(alert.encode())
-                    else:
-                        alert = f"{self.burgundy}Spaces can not be included in username{self.base}"
-                        socket.send(alert.encode())
-
-                elif command.strip().lower() == 'pm':
-                    receiverUsername = ""
-                    # if the parameter is empty.
-                    if socket.name is not None:
-                        # check if the parameter is in right form
-                        try:
-                            receiverUsername, message = parameters.split(',', 1)
-                        except ValueError:
-                            alert = (f"{self.burgundy}Invalid usage: please use /pm <username> <message>.{self.base}")
-                            socket.send(alert.encode())
-                        if receiverUsername == "":
-                            socket.send(f"{self.burgundy}Invalid usage: please use /pm <username> <message>.{self.base}".encode())
-                        # check if the receiver's username is in the connected user list.
-                        elif receiverUsername in self.userNameKeyObjectValueDict and receiverUsername != socket.name:
-                            receiverSocket = self.userNameKeyObjectValueDict[receiverUsername]
-                            message = ' '.join(message.split(", "))
-                            privateMessageFrom = f"{self.cyan}Private message from {socket.name}: {message}{self.base}"
-                            receiverSocket.send(privateMessageFrom.encode())
-                            privateMessageTo = f"{self.margenta}Private message to {receiverUsername}: {message}{self.base}"
-                            socket.send(privateMessageTo.encode())
-                        # if the receiver's username is not in the connected userlist, alert it.
-                        else:
-                            alert = f"{self.burgundy}User name {receiverUsername} does not exsit{self.base}"
-                            socket.send(alert.encode())
-                    else:
-                        socket.send(f"{self.burgundy}Set username before sending message.{self.base}".encode())
-
-                # print out userlist.
-                elif command.strip().lower() == 'userlist':
-                    userList = []
-                    for username in self.userNameKeyObjectValueDict.keys():
-                        userList.append(username) 
-                    userList = '\n'.join(userList)
-                    userList = f"{self.yellow}{userList}{self.base}"
-                    socket.send(userList.encode())
-
-                # helper command
-                elif command.strip().lower() == 'help':
-                    help_message = f"{self.yellow}Available commands:\n" \
-                    "/userlist: Get the list of currently connected users. Usage: /userlist\n" \
-                    "/pm: Send a private message to a specific user. Usage: /pm <username>, <message_content>\n" \
-                    "/help: Display this help message. Usage: /help\n" \
-                    "/username: Set your username. Usage: /username <desired_username>\n" \
-                    f"/close: Close the connection to the server. Useage: /close{self.base}"
-                    socket.send(help_message.encode())
-
-                elif command.strip().lower() == "close":
-                    alert = f"{self.burgundy}closing connection with the server.{self.base}"
-                    socket.send(alert.encode())
-                    # close socket (automatically calls onDisconnect()
-                    socket.close()
-                    # Disconnect socket
-                    return False
-
-                else:
-                    alert = f"{self.burgundy}Please type a valid command and parameters.\n" \
-                    f"Use /help to refer usage of command and parameters.{self.base}"
-                    socket.send(alert.encode())
+            # split the message once into the lower cased command name and its parameters.
+            command = Command(message)
+            log.debug("Command is :: %s", command.name)
+            log.debug("Parameters are :: %s", command.args)
+            self._count(command.name)
+
+            # look up the handler registered with @command, commands are plugged in there rather than here.
+            socket.throttled = False
+            handler = self.handlers.get(command.name)
+            if handler is not None:
+                try:
+                    return handler(self, socket, command)
+                # the hub did not answer, only this command fails and the user may try it again.
+                except (TimeoutError, ConnectionError) as error:
+                    log.warning("Bus request failed for /%s: %s", command.name, error)
+                    socket.sendMessage(ERROR, "The other servers can not be reached right now, please try again")
+                    return True
+
+            # if user only type '/' or an unknown command, alert that user to use valid command and parameters.
+            alert = "Please type a valid command and parameters.\n" \
+            "Use /help to refer usage of command and parameters."
+            socket.sendMessage(ERROR, alert)
 
         # if user just type a message, it then be a instant message to the whole connected users. 
         else:
+            self._count('message')
             # if the message sender has not yet registered their username.
             if socket.name == None:
-                alert = f"{self.burgundy}Set your username before sending a message{self.base}"
-                socket.send(alert.encode())
+                socket.sendMessage(ERROR, "Set your username before sending a message")
 
-            # when there is no user connected.
-            elif len(self.userNameKeyObjectValueDict) <= 1:
-                alert = f"{self.burgundy}There is no connected user to receive a message{self.base}"
-                socket.send(alert.encode())
+            # when there is no user connected, other workers may have users though.
+            elif len(self.registry.members()) <= 1 and self.bus is None:
+                socket.sendMessage(ERROR, "There is no connected user to receive a message")
 
             # when a user type nothing, alert the user.
             elif message.strip() == '':
-                alert = f"{self.burgundy}Type any message to send other than whitespace{self.base}"
-                socket.send(alert.encode())
+                socket.sendMessage(ERROR, "Type any message to send other than whitespace")
+
+            # when the whole server is broadcasting more than it is allowed to.
+            elif not self._takeBroadcast():
+                self._throttle(socket, 'broadcast', "The chat room is too busy, your message was not sent")
+
+            # with a room joined the message only goes to that room's members.
+            elif socket.room is not None:
+                socket.throttled = False
+                socket.sendMessage(ROOM_ECHO, message, target=socket.room)
+                frames = self._record(ROOM_PUBLIC, message, socket.name, socket.room)
+                self.broadcastMessage(self.rooms.members(socket.room), ROOM_PUBLIC, message, socket.name, socket.room,
+                                      exclude=socket, frames=frames)
+                self._publish(ROOM_PUBLIC, message, socket.name, socket.room)
 
             # send a message to all the user in the chatroom, not to the user without username.
+            # the message is encoded once per protocol and the same buffer goes to every recipient.
             else:
-                for client_socket in self.userNameKeyObjectValueDict.values():
-                    if client_socket == socket:
-                        client_socket.send(f"{self.violet}Message to everyone: {message}{self.base}".encode())
-                        continue
-                    client_socket.send(f"{self.green}Message from {socket.name}: {message}{self.base}".encode())
+                socket.throttled = False
+                socket.sendMessage(ECHO, message)
+                frames = self._record(PUBLIC, message, socket.name)
+                self.broadcastMessage(self.registry.members(), PUBLIC, message, socket.name, exclude=socket, frames=frames)
+                self._publish(PUBLIC, message, socket.name)
 
         # Signify all is well
         return True
-    
 
-# Parse the IP address and port you wish to listen on.
-ip = sys.argv[1]
-port = int(sys.argv[2])
+    # every handler takes the socket and the parsed Command, and returns False to disconnect the user.
+
+    @command('username')
+    def onUsername(self, socket, command):
+        # when the user tries to set their username as ' ' or with spaces in it.
+        if len(command.args) != 1:
+            socket.sendMessage(ERROR, "Spaces can not be included in username")
+            return True
+        username = command.args[0]
+        if len(username) > self.maxNameLength:
+            socket.sendMessage(ERROR, f"Username can be at most {self.maxNameLength} characters long")
+            return True
+
+        # with worker processes the bus decides whether the name is free on all of them.
+        claim = None
+        if self.bus is not None and socket.name != username:
+            claim = self.bus.request('claim', name=username, old=socket.name)
+        # if another worker already has that username.
+        if claim is not None and not claim['ok']:
+            outcome = 'taken'
+        # otherwise claim it atomically: 'set' if the user has not been regiesterd username before at all,
+        # 'changed' if they had one, 'same' if it is already theirs and 'taken' if another user has it.
+        else:
+            outcome = self.registry.claim(socket, username)
+
+        if outcome == 'set':
+            # set the username into socket.name.
+            socket.name = username
+            with self._stateLock:
+                # increment the numser of user in the chatroom by 1.
+                self.userNoInChatRoom += 1
+                userNoInChatRoom = self.userNoInChatRoom if claim is None else claim['count']
+            # notice the user that the username has set.
+            socket.sendMessage(NOTICE, f"Username has set to {username}")
+            # catch the new user up with what was said before they came, in one write.
+            if self.history is not None:
+                self.history.replay(socket)
+            self._deliverMail(socket, self._takeMail(claim, username))
+            # notice all the chatroom connected user that the new user has connected to the chatroom.
+            message = f"{username} has been connected to the chatroom, Current user in the chat room: {userNoInChatRoom}"
+            self.broadcastMessage(self._unsubscribed(self.registry.members()), NOTICE, message)
+            self._publish(NOTICE, message, audience='notices')
+            self._presence(username, 1)
+        elif outcome == 'same':
+            socket.sendMessage(ERROR, f"Username already set to {username}")
+        elif outcome == 'taken':
+            socket.sendMessage(ERROR, "Username has already taken")
+        else:
+            self._presence(socket.name, -1)
+            self._presence(username, 1)
+            socket.name = username
+            socket.sendMessage(NOTICE, f"Username has changed to {username}")
+            self._deliverMail(socket, self._takeMail(claim, username))
+        return True
+
+    @command('pm')
+    def onPrivateMessage(self, socket, command):
+        if socket.name is None:
+            socket.sendMessage(ERROR, "Set username before sending message.")
+            return True
+        # the receiver ends at the first space or comma, so both /pm bob hi and /pm bob, hi work.
+        (receiverUsername, comma, first) = command.args[0].partition(',') if command.args else ("", "", "")
+        message = ' '.join([first] + command.args[1:] if first else command.args[1:])
+        # check if the parameter is in right form
+        if receiverUsername == "" or message == "":
+            socket.sendMessage(ERROR, "Invalid usage: please use /pm <username> <message>.")
+        elif receiverUsername.casefold() == socket.name.casefold():
+            socket.sendMessage(ERROR, f"User name {receiverUsername} does not exsit")
+        else:
+            # send it if the receiver is connected, otherwise keep it in the mailbox, if there is one.
+            outcome = self._sendPrivate(receiverUsername, socket.name, message)
+            if outcome == 'sent':
+                socket.sendMessage(PRIVATE_TO, message, target=receiverUsername)
+            elif outcome == 'stored':
+                socket.sendMessage(NOTICE, f"{receiverUsername} is not connected, they will get your message once they set that username")
+            elif outcome == 'full':
+                socket.sendMessage(ERROR, f"{receiverUsername} is not connected and has too many messages waiting already")
+            # if the receiver's username is not in the connected userlist, alert it.
+            else:
+                socket.sendMessage(ERROR, f"User name {receiverUsername} does not exsit")
+        return True
+
+    # print out userlist.
+    @command('userlist')
+    def onUserlist(self, socket, command):
+        # an optional trailing page number, and before it an optional prefix the usernames start with.
+        args = command.args
+        page = int(args[-1]) if args and args[-1].isdigit() else None
+        if page is not None:
+            args = args[:-1]
+        if len(args) > 1 or page == 0:
+            socket.sendMessage(ERROR, "Invalid usage: please use /userlist [prefix] [page].")
+            return True
+        prefix = args[0] if args else ''
+        page = page or 1
+
+        # pages are encoded once per version of the usernames and reused until they change.
+        (version, names, keys) = self._names()
+        key = (prefix.casefold(), page)
+        with self._stateLock:
+            if self._userlistPages[0] != version:
+                self._userlistPages = (version, {})
+            pages = self._userlistPages[1]
+            cached = pages.get(key)
+        if cached is None:
+            cached = self._userlistPage(names, keys, prefix, page)
+            with self._stateLock:
+                if len(pages) < 256:
+                    pages[key] = cached
+        (kind, body, frames) = cached
+        socket.sendMessage(kind, body, frames=frames)
+        return True
+
+    @command('presence')
+    def onPresence(self, socket, command):
+        if command.args not in (['on'], ['off']):
+            socket.sendMessage(ERROR, "Invalid usage: please use /presence on or /presence off.")
+        elif command.args[0] == 'on':
+            with self._stateLock:
+                self.presenceSubscribers.add(socket)
+            socket.sendMessage(NOTICE, f"Presence updates on, joins and leaves come together every {self.presenceInterval:g}s")
+        else:
+            with self._stateLock:
+                self.presenceSubscribers.discard(socket)
+            socket.sendMessage(NOTICE, "Presence updates off, every join and leave comes as a notice")
+        return True
+
+    # helper command
+    @command('help')
+    def onHelp(self, socket, command):
+        help_message = "Available commands:\n" \
+        "/userlist: Get the list of currently connected users, a page at a time and optionally only those starting with prefix. Usage: /userlist [prefix] [page]\n" \
+        "/presence: Get joins and leaves together every so often instead of one notice each. Usage: /presence on|off\n" \
+        "/pm: Send a private message to a specific user, kept until they come back if they are away and the server has a mailbox. Usage: /pm <username>, <message_content>\n" \
+        "/help: Display this help message. Usage: /help\n" \
+        "/username: Set your username. Usage: /username <desired_username>\n" \
+        "/join: Join a room, or open it, and send your messages there. Usage: /join <room>\n" \
+        "/part: Leave a room. Usage: /part <room>\n" \
+        "/rooms: Get the list of rooms and how many users are in each. Usage: /rooms\n" \
+        "/stats: Show the server's metrics, from the server's own machine only. Usage: /stats\n" \
+        "/close: Close the connection to the server. Useage: /close"
+        socket.sendMessage(NOTICE, help_message)
+        return True
+
+    @command('join')
+    def onJoinRoom(self, socket, command):
+        if socket.name is None:
+            socket.sendMessage(ERROR, "Set username before joining a room.")
+        elif len(command.args) != 1:
+            socket.sendMessage(ERROR, "Invalid usage: please use /join <room>.")
+        elif len(command.args[0]) > self.maxNameLength:
+            socket.sendMessage(ERROR, f"Room name can be at most {self.maxNameLength} characters long")
+        else:
+            (room, joined) = self.rooms.join(socket, command.args[0])
+            # joining again just makes the room the one messages go to.
+            socket.room = room
+            if joined:
+                with self._stateLock:
+                    history = self.roomHistory.get(room.casefold())
+                if history is not None:
+                    history.replay(socket)
+                notice = f"{socket.name} has joined {room}"
+                self.broadcastMessage(self.rooms.members(room), NOTICE, notice, target=room)
+                if self.bus is not None:
+                    self.bus.publish('join', room=room)
+                    self._publish(NOTICE, notice, room=room)
+            else:
+                socket.sendMessage(NOTICE, f"Messages now go to {room}")
+        return True
 
-# Create an echo server.
-server = MyServer()
+    @command('part')
+    def onPartRoom(self, socket, command):
+        if len(command.args) != 1:
+            socket.sendMessage(ERROR, "Invalid usage: please use /part <room>.")
+            return True
+        room = self.rooms.part(socket, command.args[0])
+        if room is None:
+            socket.sendMessage(ERROR, f"You are not in {command.args[0]}")
+            return True
+        # messages go back to the whole chat room once the user leaves the room they are talking in.
+        if socket.room is not None and socket.room.casefold() == room.casefold():
+            socket.room = None
+            socket.sendMessage(NOTICE, f"You have left {room}, messages now go to everyone")
+        else:
+            socket.sendMessage(NOTICE, f"You have left {room}")
+        self._forget(room)
+        notice = f"{socket.name} has left {room}"
+        self.broadcastMessage(self.rooms.members(room), NOTICE, notice, target=room)
+        if self.bus is not None:
+            self.bus.publish('part', room=room)
+            self._publish(NOTICE, notice, room=room)
+        return True
+
+    @command('rooms')
+    def onRooms(self, socket, command):
+        # the hub only lists the biggest rooms of the whole federation.
+        if self.bus is not None:
+            reply = self.bus.request('rooms')
+            (rooms, more) = (reply['rooms'], reply['total'] - len(reply['rooms']))
+        else:
+            (rooms, more) = (self.rooms.rooms(), 0)
+        if rooms:
+            lines = [f"{room} ({count})" for room, count in sorted(rooms)]
+            if more:
+                lines.append(f"and {more} smaller rooms")
+            socket.sendMessage(USER_LIST, '\n'.join(lines))
+        else:
+            socket.sendMessage(NOTICE, "There are no rooms yet, /join <room> to open one")
+        return True
+
+    # server metrics, for operators on the server's machine.
+    @command('stats')
+    def onStats(self, socket, command):
+        if self.metrics is None:
+            socket.sendMessage(ERROR, "Metrics are not enabled on this server")
+        elif not self._isLocal(socket):
+            socket.sendMessage(ERROR, "/stats is only available from the server's own machine")
+        else:
+            socket.sendMessage(NOTICE, self.metrics.expose().rstrip('\n'))
+        return True
+
+    @command('close')
+    def onClose(self, socket, command):
+        socket.sendMessage(ERROR, "closing connection with the server.")
+        # close socket (automatically calls onDisconnect()
+        socket.close()
+        # Disconnect socket
+        return False
+    
 
-# Start server
-server.start(ip, port)
+def serve(ip, port, backend, metricsPort=None, bus=None, reusePort=False, history=100, historyLog=None,
+          idleTimeout=None, heartbeatTimeout=10, limits=(None, None, None), capture=None, mailbox=None,
+          backlog=None, maxConnections=None):
+    """
+    Run one MyServer, with its metrics on metricsPort when given. It keeps the last
+    history chat room messages, none when 0, also appending them to the log at historyLog.
+    Users silent for idleTimeout seconds are pinged and dropped unless they answer
+    within heartbeatTimeout. limits are the per connection, per username and broadcast
+    (rate, burst) rate limits, None for no limit. With capture, every connect, message
+    and disconnect is recorded in that file for replay.py. With mailbox, the path of an
+    SQLite database, private messages for users who are not connected are kept there,
+    unless there is a bus, whose hub keeps them. backlog is the listen backlog, None for the
+    system's largest, and beyond maxConnections users are told the server is full and
+    disconnected, None for no limit.
+    """
+    metrics = None
+    if metricsPort is not None:
+        metrics = Metrics()
+        metrics.serve('127.0.0.1', metricsPort)
+    messageLog = MessageLog(historyLog) if history and historyLog is not None else None
+    recorder = Capture(capture) if capture is not None else None
+    mail = Mailbox(mailbox) if mailbox is not None and bus is None else None
+    try:
+        server = MyServer(bus, metrics, History(history, messageLog) if history else None, mail)
+        if recorder is not None:
+            server.record(recorder)
+        server.idleTimeout = idleTimeout
+        server.heartbeatTimeout = heartbeatTimeout
+        if backlog is not None:
+            server.backlog = backlog
+        server.maxConnections = maxConnections
+        (server.rateLimit, server.userRateLimit, server.broadcastRateLimit) = limits
+        # stop gracefully on termination too, users get told and what is queued for them is flushed.
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        server.start(ip, port, backend, reusePort=reusePort)
+    finally:
+        if messageLog is not None:
+            messageLog.close()
+        if recorder is not None:
+            recorder.close()
+        if mail is not None:
+            mail.close()
+
+
+def launch(ip, port, backend, workers, metricsPort=None, logLevel=logging.INFO, history=100, historyLog=None,
+           idleTimeout=None, heartbeatTimeout=10, limits=(None, None, None), hub=None, link=None, secret=None,
+           capture=None, mailbox=None, backlog=None, maxConnections=None):
+    """
+    Fork worker processes sharing the port, linked by a BusHub in this process.
+    Worker n serves its metrics on metricsPort + n, keeps its history log at historyLog.n
+    and its capture at capture.n, each worker records every chat room message. Rate limits and maxConnections apply to each
+    worker on its own.
+
+    The hub listens on a Unix socket, or with hub on that (ip, port) so the servers on other
+    hosts or ports can link to it and share the chat room. With link, the (host, port) of
+    another server's hub, the workers join that one instead and no hub runs here. secret is
+    the hub's shared secret, if it has one. A hub other hosts can reach must have one, or
+    anyone could read the chat and take usernames, ValueError is raised without it. The hub
+    keeps the private messages for users connected to no worker in the SQLite database at
+    mailbox, when given.
+
+    A worker that crashes logs why and exits with status 1, the others keep serving.
+    Returns 1 once they have all stopped if any of them crashed, 0 otherwise.
+    """
+    if hub is not None and secret is None and not isLoopback(hub[0]):
+        raise ValueError(f"a hub on {hub[0]} is reachable from other hosts and needs a secret")
+    directory = None
+    if link is not None:
+        address = link
+    elif hub is not None:
+        address = ('127.0.0.1' if hub[0] in ('', '0.0.0.0') else hub[0], hub[1])
+    else:
+        directory = tempfile.mkdtemp(prefix='myserver-')
+        address = os.path.join(directory, 'bus')
+
+    # key = pid, value = worker number, of the workers still running
+    children = {}
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # worker process: join the bus, then serve on the shared port.
+            (listener, status) = (None, 0)
+            try:
+                listener = startLogging(logLevel)
+                bus = BusClient()
+                bus.start(address, secret=secret)
+                serve(ip, port, backend, None if metricsPort is None else metricsPort + worker, bus, reusePort=True,
+                      history=history, historyLog=None if historyLog is None else f"{historyLog}.{worker}",
+                      idleTimeout=idleTimeout, heartbeatTimeout=heartbeatTimeout, limits=limits,
+                      capture=None if capture is None else f"{capture}.{worker}", backlog=backlog,
+                      maxConnections=maxConnections)
+            except Exception:
+                # say why before going, and exit non-zero so the parent sees the worker failed.
+                log.exception("Worker %d crashed", worker)
+                status = 1
+            finally:
+                if listener is not None:
+                    listener.stop()
+                os._exit(status)
+        children[pid] = worker
+
+    # turn termination into an exception so the workers are always taken down with us.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # the hub starts after the fork so the workers do not inherit its sockets.
+    busHub = None
+    if link is None:
+        busHub = BusHub()
+        busHub.secret = secret
+        busHub.mailbox = Mailbox(mailbox) if mailbox is not None else None
+        (hubIp, hubPort) = hub if hub is not None else (address, None)
+        threading.Thread(target=busHub.start, args=(hubIp, hubPort, 'selector'), daemon=True).start()
+    failed = False
+    try:
+        while children:
+            (pid, status) = os.wait()
+            worker = children.pop(pid, None)
+            if worker is not None and os.waitstatus_to_exitcode(status) != 0:
+                log.error("Worker %d exited with status %d", worker, os.waitstatus_to_exitcode(status))
+                failed = True
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        # the workers shut down gracefully within their drain timeout, keep the bus up until they have.
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        if busHub is not None:
+            busHub.stop()
+            if busHub.mailbox is not None:
+                busHub.mailbox.close()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+    return 1 if failed else 0
+
+
+def rateLimit(text):
+    """Parse "RATE" or "RATE:BURST" messages a second, None for 0. The burst defaults to twice the rate."""
+    (rate, separator, burst) = text.partition(':')
+    rate = float(rate)
+    if rate <= 0:
+        return None
+    return (rate, float(burst) if separator else 2 * rate)
+
+
+def hostPort(text):
+    """Parse "[HOST:]PORT", the host defaulting to 127.0.0.1."""
+    (host, separator, port) = text.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def isLoopback(host):
+    """Whether only this machine can connect to host."""
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+if __name__ == "__main__":
+    # Parse the IP address and port you wish to listen on.
+    parser = argparse.ArgumentParser(description="Run the chat server.")
+    parser.add_argument('ip')
+    parser.add_argument('port', type=int)
+    # Optionally pick the connection backend, 'thread' (default) or 'selector'.
+    parser.add_argument('backend', nargs='?', default='thread', choices=['thread', 'selector'])
+    parser.add_argument('--workers', type=int, default=1, help="worker processes sharing the port through SO_REUSEPORT")
+    parser.add_argument('--metrics-port', type=int, help="serve Prometheus style metrics over HTTP on 127.0.0.1 at this port")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="DEBUG also logs every command")
+    parser.add_argument('--history', type=int, default=100, metavar='N',
+                        help="chat room messages replayed to users as they set their username, and room messages on /join, 0 for none")
+    parser.add_argument('--history-log', metavar='PATH', help="also append the chat room messages to this file, kept across restarts")
+    parser.add_argument('--idle-timeout', type=float, default=300, metavar='SECONDS',
+                        help="ping users silent for this long and drop those that do not answer, 0 to never")
+    parser.add_argument('--heartbeat-timeout', type=float, default=30, metavar='SECONDS',
+                        help="how long a pinged user has to answer")
+    parser.add_argument('--rate', type=rateLimit, default='30', metavar='RATE[:BURST]',
+                        help="messages a second each connection may send, 0 for no limit")
+    parser.add_argument('--user-rate', type=rateLimit, default='15', metavar='RATE[:BURST]',
+                        help="messages a second each username may send, 0 for no limit")
+    parser.add_argument('--broadcast-rate', type=rateLimit, default='300', metavar='RATE[:BURST]',
+                        help="chat room and room messages a second the server broadcasts in all, 0 for no limit")
+    # servers on other hosts or ports share one chat room by linking to the hub of one of them.
+    federation = parser.add_mutually_exclusive_group()
+    federation.add_argument('--hub', type=hostPort, metavar='[IP:]PORT',
+                            help="run the hub other servers link to on this address, 0.0.0.0 for every interface")
+    federation.add_argument('--link', type=hostPort, metavar='[HOST:]PORT', help="join the chat room of the server whose hub is here")
+    parser.add_argument('--link-secret', metavar='SECRET', help="shared secret the hub asks of the servers that link to it")
+    parser.add_argument('--capture', metavar='PATH', help="record the traffic users send to this file, to run it again with replay.py")
+    parser.add_argument('--backlog', type=int, metavar='N',
+                        help="connections the kernel queues until they are accepted, by default and at most net.core.somaxconn")
+    parser.add_argument('--max-connections', type=int, default=0, metavar='N',
+                        help="users served at once, each worker on its own, beyond it they are told the server is full. 0 for no limit")
+    parser.add_argument('--mailbox', metavar='PATH',
+                        help="keep /pm for users who are not connected in this SQLite database, until they set that username")
+    args = parser.parse_args()
+    limits = (args.rate, args.user_rate, args.broadcast_rate)
+    # without a secret every host that reaches the hub is let in, to read the chat and claim usernames.
+    if args.hub is not None and args.link_secret is None and not isLoopback(args.hub[0]):
+        parser.error(f"--hub on {args.hub[0]} is reachable from other hosts, give it a --link-secret")
+
+    if args.workers > 1 or args.hub is not None or args.link is not None:
+        sys.exit(launch(args.ip, args.port, args.backend, args.workers, args.metrics_port, args.log_level, args.history, args.history_log,
+                        args.idle_timeout or None, args.heartbeat_timeout, limits, args.hub, args.link, args.link_secret, args.capture,
+                        args.mailbox, args.backlog, args.max_connections or None))
+    else:
+        listener = startLogging(args.log_level)
+        try:
+            # Create an echo server and start it.
+            serve(args.ip, args.port, args.backend, args.metrics_port, history=args.history, historyLog=args.history_log,
+                  idleTimeout=args.idle_timeout or None, heartbeatTimeout=args.heartbeat_timeout, limits=limits,
+                  capture=args.capture, mailbox=args.mailbox, backlog=args.backlog,
+                  maxConnections=args.max_connections or None)
+        finally:
+            listener.stop()
 
@@ -0,0 +1,170 @@
+"""
+Chat server traffic replay
+
+This script runs traffic recorded with myserver.py --capture against a fresh
+myserver.py on a local port, so a problem seen under real load can be
+reproduced, and two versions of the server compared on the same traffic.
+
+Usage:
+   python3 myserver.py 0.0.0.0 8090 --capture traffic.cap
+   python3 replay.py traffic.cap [traffic.cap.1 ...] [--backend thread|selector] [--speed 1] [--output results.json]
+
+  Every captured connection is opened again when it was first seen, sends
+  the same lines at the same offsets from the start and closes when it
+  did. --speed 2 replays twice as fast, --speed 0 as fast as possible, one
+  event straight after the other. The captures of the workers of one
+  server, traffic.cap.0, traffic.cap.1 and so on, are merged by time.
+
+  Each line is followed by a /ping, which the server answers once it has
+  handled the line, so the time to its /pong is the latency of the line.
+  Reports lines per second, p50/p99 latency and the server's CPU time and
+  resident memory. --output writes them as JSON, tagged with the git commit.
+  The rate limits are off so the replay is never throttled, and lines go
+  over text connections whatever protocol they were captured on.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import platform
+import selectors
+import time
+
+from benchmark import LoadClient, freePort, gitCommit, latencies, serverUsage, startServer
+from ex2utils import CAPTURE_CONNECT, CAPTURE_MESSAGE, CAPTURE_DISCONNECT, Command, readCapture
+
+
+def keyed(index, path):
+    """The events of one capture, its connections keyed by (index, number)."""
+    for (kind, at, number, message) in readCapture(path):
+        yield (kind, at, (index, number), message)
+
+
+def events(paths):
+    """The events of every capture merged by time."""
+    return heapq.merge(*[keyed(index, path) for (index, path) in enumerate(paths)], key=lambda event: event[1])
+
+
+def replay(port, server, paths, speed, timeout=300):
+    """Run the captured events against the server, returns throughput, latency and server usage."""
+    selector = selectors.DefaultSelector()
+    # key = captured connection, value = the LoadClient replaying it
+    clients = {}
+    samples = []
+    tokens = itertools.count()
+    counts = {'connections': 0, 'messages': 0, 'skipped': 0}
+
+    def onLine(client, line):
+        if line.startswith(b'/pong '):
+            sentAt = client.sentAt.pop(line[6:].strip(), None)
+            if sentAt is not None:
+                samples.append(time.perf_counter_ns() - sentAt)
+            if client.closing and not client.sentAt:
+                close(client)
+
+    def close(client):
+        selector.unregister(client.socket)
+        client.socket.close()
+        client.closing = True
+
+    def read(wait):
+        for key, mask in selector.select(wait):
+            client = key.data
+            client.receive(None)
+            # the server hung up, the lines still waiting for their pong will never get it
+            if client.closed:
+                client.sentAt.clear()
+                close(client)
+
+    def apply(kind, connection, message):
+        client = clients.get(connection)
+        if kind == CAPTURE_CONNECT:
+            client = clients[connection] = LoadClient(port)
+            client.sentAt = {}
+            client.closing = False
+            client.onLine = lambda line, client=client: onLine(client, line)
+            selector.register(client.socket, selectors.EVENT_READ, client)
+            counts['connections'] += 1
+        elif client is None or client.closing:
+            # the capture started after the connection did
+            counts['skipped'] += 1
+        elif kind == CAPTURE_MESSAGE:
+            counts['messages'] += 1
+            data = message.encode() + b'\n'
+            # the server closes the connection on /close, so nothing would answer a ping behind it
+            if not (message.startswith('/') and Command(message).name == 'close'):
+                token = b'%d' % next(tokens)
+                client.sentAt[token] = time.perf_counter_ns()
+                data += b'/ping ' + token + b'\n'
+            try:
+                client.send(data)
+            except OSError:
+                # the server hung up before we read that it had
+                client.sentAt.clear()
+                close(client)
+        elif kind == CAPTURE_DISCONNECT:
+            # hang up once every line has been answered
+            client.closing = True
+            if not client.sentAt:
+                close(client)
+
+    (rss, cpuBefore) = serverUsage(server.pid)
+    start = time.perf_counter()
+    try:
+        for (kind, at, connection, message) in events(paths):
+            if speed:
+                due = start + at / speed
+                while time.perf_counter() < due:
+                    read(due - time.perf_counter())
+            else:
+                read(0)
+            apply(kind, connection, message)
+        deadline = time.perf_counter() + timeout
+        while any(client.sentAt for client in clients.values()):
+            if time.perf_counter() > deadline:
+                raise RuntimeError("timed out waiting for the server")
+            read(0.1)
+        elapsed = time.perf_counter() - start
+        (rss, cpu) = serverUsage(server.pid)
+    finally:
+        for client in clients.values():
+            client.socket.close()
+        selector.close()
+    return dict(counts, seconds=elapsed, messages_per_sec=counts['messages'] / elapsed,
+                server_cpu_seconds=cpu - cpuBefore, server_rss_bytes=rss, **latencies(samples))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic against the chat server.")
+    parser.add_argument('captures', nargs='+', help="files written by myserver.py --capture")
+    parser.add_argument('--backend', default='thread', choices=['thread', 'selector'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--speed', type=float, default=1, help="times the captured speed, 0 for as fast as possible")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    port = freePort()
+    server = startServer(port, args.backend, args.workers)
+    try:
+        result = replay(port, server, args.captures, args.speed)
+    finally:
+        server.terminate()
+        server.wait()
+    print(f"{result['connections']} connections, {result['messages']} lines, {args.backend} backend, "
+          f"{args.workers} workers, speed {args.speed:g}")
+    latency = f"p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  max {result['max_ms']:8.2f} ms" if result['samples'] else ''
+    print(f"  {result['seconds']:8.3f} s  {result['messages_per_sec']:>10.0f} lines/s  {latency}")
+    print(f"  server cpu {result['server_cpu_seconds']:6.3f} s  rss {result['server_rss_bytes'] / 2**20:7.1f} MiB")
+    if result['skipped']:
+        print(f"  {result['skipped']} events of connections opened before the capture were skipped")
+    if args.output:
+        report = {'commit': gitCommit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'backend': args.backend,
+                  'workers': args.workers, 'speed': args.speed, 'captures': args.captures,
+                  'python': platform.python_version(), 'result': result}
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()